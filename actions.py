@@ -23,9 +23,9 @@ class Action():
 
     def __call__(self, *args):
         if self.call_with_action_name:
-            self.__action(self.name, *args)
+            return self.__action(self.name, *args)
         else:
-            self.__action(*args)
+            return self.__action(*args)
 
     def __repr__(self):
         return self.usage
@@ -0,0 +1,380 @@
+###############################################################################
+#
+# Copyright (C) 2015 Aleksandrina Nikolova <aayla.secura.1138@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+# Offline analysis of lfi-3751-control logs
+# Requires numpy for all but the classes
+
+"""Statistics of temperature data, of whole logs and of live readings.
+
+The functions take NumPy arrays (which may be memory-mapped logs, see
+logfile.py) and work on whole columns at once, so that logs of millions of
+rows are processed in seconds. Missing values are NaN.
+
+The classes take one reading at a time, as get_response in
+lfi-3751-control does, and do a constant amount of work for each. They do
+not need NumPy, which is only imported once a function needs it.
+
+Temperatures are compared in whole mK (the resolution of the device), so
+that sums of differences are exact and the live and offline results agree.
+
+Exported classes:
+SettleDetector: tells when readings have stabilized.
+ApproachModel: predicts the temperature an exponential approach ends at.
+
+Exported functions:
+column_stats: count, minimum, maximum, mean and standard deviation of
+    every column.
+response_points: the stabilization point of every set point in the log of
+    a response curve, as get_response in lfi-3751-control finds them.
+decimate: the minimum and maximum of y in buckets of x, for plotting.
+to_mk: temperatures in C in whole mK.
+"""
+
+from collections import deque
+from numbers import Real
+
+# columns of the array returned by response_points, the first six are the
+# columns of the _response.log written by lfi-3751-control
+RESPONSE_COLUMNS = ['time/s', 'SET_T', 'ACT_T', 'act_t_avg', 'act_t_delta',
+                    'sample_time', 'overshoot', 'settled']
+
+STATS_CHUNK = 1 << 20       # rows per chunk in column_stats
+
+def column_stats(data, chunk = STATS_CHUNK):
+    """Return count, min, max, mean and std of the columns of data.
+
+    Each is a 1-D array with a value per column, NaN for a column with no
+    values. data is read chunk rows at a time, so that a memory-mapped log
+    is never copied as a whole; means and variances of chunks are combined
+    as in Chan et al., which unlike sums of squares does not lose precision
+    for small deviations from large values (e.g. of temperatures).
+    """
+    import numpy
+
+    columns = data.shape[1]
+    count = numpy.zeros(columns)
+    minimum = numpy.full(columns, numpy.nan)
+    maximum = numpy.full(columns, numpy.nan)
+    mean = numpy.zeros(columns)
+    m2 = numpy.zeros(columns)       # sum of squared deviations from mean
+
+    for start in range(0, len(data), chunk):
+        block = numpy.asarray(data[start : start + chunk], dtype = float)
+        valid = ~numpy.isnan(block)
+        block_count = valid.sum(axis = 0)
+        if not block_count.any():
+            continue
+
+        filled = numpy.where(valid, block, 0)
+        block_mean = filled.sum(axis = 0) / numpy.maximum(block_count, 1)
+        block_m2 = (numpy.where(valid, block - block_mean, 0) ** 2).sum(
+            axis = 0)
+
+        total = count + block_count
+        delta = block_mean - mean
+        weight = block_count / numpy.maximum(total, 1)
+        mean = mean + delta * weight
+        m2 = m2 + block_m2 + delta ** 2 * count * weight
+        count = total
+
+        # fmin/fmax ignore NaN
+        minimum = numpy.fmin(minimum, numpy.fmin.reduce(block, axis = 0))
+        maximum = numpy.fmax(maximum, numpy.fmax.reduce(block, axis = 0))
+
+    empty = count == 0
+    mean[empty] = numpy.nan
+    std = numpy.sqrt(m2 / numpy.maximum(count, 1))
+    std[empty] = numpy.nan
+    return count, minimum, maximum, mean, std
+
+def response_points(time, set_t, act_t, samples, max_error):
+    """Return the stabilization point of every set point.
+
+    time, set_t and act_t are the columns of the log of a response curve.
+    The temperature is stable at a row if the mean absolute difference
+    between its ACT_T and the samples preceding ones (for the same set
+    point) is at most max_error mK; the first such row of each set point is
+    its stabilization point. If there is none (the set point timed out),
+    its last row is used instead.
+
+    Returns a 2-D array with a row per set point and RESPONSE_COLUMNS:
+    the time, SET_T and ACT_T of the point, the mean ACT_T of the samples
+    before it (including it for a timeout), the sum of absolute differences
+    from them, the seconds since the first row of the set point, the
+    largest excursion of ACT_T past SET_T in the direction of the step from
+    the previous set point (0 if none) and 1 if the temperature settled, 0
+    if it timed out.
+    """
+    import numpy
+
+    # rows without ACT_T are skipped when reading the data live too
+    valid = ~numpy.isnan(act_t)
+    time = numpy.asarray(time)[valid]
+    set_t = numpy.asarray(set_t)[valid]
+    act_t = numpy.asarray(act_t)[valid]
+    act_mk = to_mk(act_t)
+    rows = len(act_t)
+    if rows == 0:
+        return numpy.empty((0, len(RESPONSE_COLUMNS)))
+
+    # runs of the same set point
+    starts = numpy.concatenate(([0], numpy.flatnonzero(
+        set_t[1:] != set_t[:-1]) + 1))
+    ends = numpy.append(starts[1:], rows) - 1
+    lengths = ends - starts + 1
+    position = numpy.arange(rows) - numpy.repeat(starts, lengths)
+
+    # sum of absolute differences (in mK) from the preceding samples, one
+    # pass per lag rather than a (rows, samples) array
+    error = numpy.zeros(rows, dtype = numpy.int64)
+    for lag in range(1, min(samples, rows - 1) + 1):
+        error[lag:] += numpy.abs(act_mk[lag:] - act_mk[:-lag])
+    full = position >= samples
+    stable = full & (error <= samples * max_error)
+
+    # first stable row of each set point, the last row if there is none
+    stable_rows = numpy.flatnonzero(stable)
+    first = numpy.searchsorted(stable_rows, starts)
+    candidate = stable_rows[numpy.minimum(first, len(stable_rows) - 1)] \
+                if len(stable_rows) else ends
+    settled = (first < len(stable_rows)) & (candidate <= ends)
+    point = numpy.where(settled, candidate, ends)
+
+    # mean of the samples before the point, or up to and including it on a
+    # timeout, from cumulative sums
+    cumulative = numpy.concatenate(([0], numpy.cumsum(act_mk)))
+    window_end = numpy.where(settled, point, point + 1)
+    window_start = numpy.maximum(starts, window_end - samples)
+    act_t_avg = (cumulative[window_end] - cumulative[window_start]) / \
+                numpy.maximum(window_end - window_start, 1) / 1000
+
+    # a step up overshoots above the set point and a step down below it,
+    # the first set point is approached from its first reading
+    previous = numpy.concatenate(([act_t[0]], set_t[starts[1:] - 1]))
+    direction = numpy.sign(set_t[starts] - previous)
+    excursion = numpy.repeat(direction, lengths) * (act_t - set_t)
+    overshoot = numpy.maximum(
+        numpy.maximum.reduceat(excursion, starts), 0)
+
+    return numpy.column_stack((
+        time[point],
+        set_t[point],
+        act_t[point],
+        act_t_avg,
+        numpy.where(full[point], error[point], 0) / 1000,
+        time[point] - time[starts],
+        overshoot,
+        settled.astype(float),
+    ))
+
+def to_mk(temp):
+    """Return temperatures in C (a number or an array) in whole mK."""
+    if isinstance(temp, Real):
+        return int(round(temp * 1000))
+
+    import numpy
+    return numpy.rint(numpy.asarray(temp) * 1000).astype(numpy.int64)
+
+class SettleDetector():
+    """Tells when readings have stabilized, as response_points does.
+
+    Readings are added one at a time with add(), which returns True once
+    the sum of absolute differences between a reading and the samples
+    readings preceding it is at most samples * max_error mK; error is that
+    sum for the last reading added (once there were samples before it) and
+    mean that of the window of readings. The window keeps its running sum
+    and minimum and maximum (in monotonic deques), so that the sum is exact
+    and found in O(1) time whenever the reading is not within the range of
+    the window, which it never is while the temperature approaches the set
+    point. Otherwise it is bounded from below by the difference from the
+    sum, and only if that does not decide it is it summed over the distinct
+    values in the window, which are few once the readings settle. A sum
+    which the bound decided is only completed if error is read, e.g. for a
+    set point which timed out.
+    """
+
+    def __init__(self, samples, max_error):
+        self.samples = samples
+        self.limit = samples * max_error
+        self.reset()
+
+    def reset(self):
+        self.window = deque()
+        self.counts = {}            # value -> number of times in window
+        self.total = 0
+        self.min_deque = deque()
+        self.max_deque = deque()
+        self.count = 0              # number of readings ever added
+        self.__error = 0            # in mK, of the last full window
+        self.__bounded = False      # whether __error is only a lower bound
+        self.__last = None          # reading and the one it replaced
+
+    @property
+    def error(self):
+        """Sum of absolute differences in mK of the last reading added to
+        a full window from the readings before it."""
+        if self.__bounded:
+            # the window before the reading was added, which replaced the
+            # oldest one
+            value, oldest = self.__last
+            self.__error = abs(value - oldest) + sum(
+                count * abs(value - other)
+                for other, count in self.counts.items())
+            self.__bounded = False
+        return self.__error
+
+    @property
+    def mean(self):
+        """Mean of the readings in the window, in C."""
+        return self.total / max(len(self.window), 1) / 1000
+
+    def add(self, temp):
+        """Add a reading (in C), return True if it is stable."""
+        value = to_mk(temp)
+        if len(self.window) >= self.samples:
+            self.__error = self.__window_error(value)
+            if self.__error <= self.limit:
+                return True
+            self.__last = value, self.__pop()
+        self.__push(value)
+        return False
+
+    def __window_error(self, value):
+        n = len(self.window)
+        self.__bounded = False
+        if value >= self.max_deque[0][1]:
+            return n * value - self.total
+        if value <= self.min_deque[0][1]:
+            return self.total - n * value
+        if abs(n * value - self.total) > self.limit:
+            self.__bounded = True
+            return abs(n * value - self.total)
+        return sum(count * abs(value - other)
+                   for other, count in self.counts.items())
+
+    def __push(self, value):
+        self.window.append(value)
+        self.counts[value] = self.counts.get(value, 0) + 1
+        self.total += value
+        while self.min_deque and self.min_deque[-1][1] >= value:
+            self.min_deque.pop()
+        self.min_deque.append((self.count, value))
+        while self.max_deque and self.max_deque[-1][1] <= value:
+            self.max_deque.pop()
+        self.max_deque.append((self.count, value))
+        self.count += 1
+
+    def __pop(self):
+        value = self.window.popleft()
+        self.counts[value] -= 1
+        if not self.counts[value]:
+            del self.counts[value]
+        self.total -= value
+        oldest = self.count - len(self.window) - 1
+        if self.min_deque[0][0] == oldest:
+            self.min_deque.popleft()
+        if self.max_deque[0][0] == oldest:
+            self.max_deque.popleft()
+        return value
+
+class ApproachModel():
+    """Predicts the temperature an exponential approach ends at.
+
+    Readings a taken at equal intervals of an exponential approach to T
+    satisfy a[k+1] - T = r (a[k] - T) with 0 < r < 1, i.e. a[k+1] is a
+    linear function of a[k]. The line is fitted by least squares to the
+    last samples pairs of consecutive readings, from running sums (of whole
+    mK, so that they are exact and do not drift as pairs are removed), and
+    T is its fixed point.
+    """
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.reset()
+
+    def reset(self):
+        self.pairs = deque()
+        self.last = None
+        self.sums = [0, 0, 0, 0]    # of x, y, x * x and x * y
+
+    def add(self, temp):
+        """Add a reading (in C)."""
+        value = to_mk(temp)
+        if self.last is not None:
+            self.__update(self.last, value, 1)
+            self.pairs.append((self.last, value))
+            if len(self.pairs) > self.samples:
+                self.__update(*self.pairs.popleft(), sign = -1)
+        self.last = value
+
+    def asymptote(self):
+        """Return the predicted final temperature in C.
+
+        Returns None until samples pairs were added or if they do not fit
+        an exponential approach (e.g. while only noise is left).
+        """
+        n = len(self.pairs)
+        if n < self.samples:
+            return None
+
+        sum_x, sum_y, sum_xx, sum_xy = self.sums
+        denominator = n * sum_xx - sum_x * sum_x
+        if denominator == 0:
+            return None
+        rate = (n * sum_xy - sum_x * sum_y) / denominator
+        if not 0 < rate < 1:
+            return None
+        offset = (sum_y - rate * sum_x) / n
+        return offset / (1 - rate) / 1000
+
+    def __update(self, x, y, sign):
+        self.sums[0] += sign * x
+        self.sums[1] += sign * y
+        self.sums[2] += sign * x * x
+        self.sums[3] += sign * x * y
+
+def decimate(x, y, buckets):
+    """Return x and y reduced to the minimum and maximum of y per bucket.
+
+    The rows are split into buckets of equal size and each is replaced by
+    two points at the x of its first row, its minimum and its maximum y,
+    which keeps the envelope of the data (unlike taking every n-th point).
+    Data with no more than 2 * buckets rows is returned as is. Raises
+    ValueError if buckets is less than 1.
+    """
+    import numpy
+
+    # numpy needs integer indices, buckets may come from a config file
+    buckets = int(buckets)
+    if buckets < 1:
+        raise ValueError('Invalid number of buckets: {buckets}'.format(
+            buckets = buckets))
+
+    rows = len(x)
+    if rows <= 2 * buckets:
+        return numpy.asarray(x), numpy.asarray(y)
+
+    size = -(-rows // buckets)
+    bucket_starts = numpy.arange(0, rows, size)
+    # reduceat works on strided (e.g. memory-mapped column) views
+    y = numpy.asarray(y)
+    ymin = numpy.fmin.reduceat(y, bucket_starts)
+    ymax = numpy.fmax.reduceat(y, bucket_starts)
+    return numpy.repeat(numpy.asarray(x)[bucket_starts], 2), \
+        numpy.column_stack((ymin, ymax)).ravel()
@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Copyright (C) 2015 Aleksandrina Nikolova <aayla.secura.1138@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+# Benchmarks for the lfi-3751-control -> seriald -> serial port path
+# Requires seriald and its dependencies, does not require root
+
+"""Benchmarks for the send_cmd -> SerialDaemon -> serial round trip.
+
+Runs the real SerialDaemon (in the foreground, in a child process) against
+the emulator (see emulator.py) on a pty, and times the client functions of
+lfi-3751-control against it. Results are printed as JSON, one object per
+scenario with the number of operations, operations per second and latency
+percentiles in seconds, e.g.:
+    bench.py --output bench.json
+    bench.py --compare bench.json --tolerance 0.2
+
+Scenarios:
+oneshot: send_cmd connecting to the daemon for every command
+persistent: send_cmd on a connection kept open
+batch: a get_data style read of several commands in one request
+concurrent: persistent send_cmd from several client processes at once
+generate_cmd: encoding of read and write commands only
+plot_data: appending to the plot window and range lookups on it
+startup: lfi-3751-control run as a new process, for a single command and
+    for a batch of commands (must be run as root, like lfi-3751-control)
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+from importlib.machinery import SourceFileLoader
+from importlib.util import module_from_spec, spec_from_loader
+from time import perf_counter, sleep, strftime, time
+
+from emulator import Emulator
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+control_path = os.path.join(bench_dir, 'lfi-3751-control')
+scenarios = ['oneshot', 'persistent', 'batch', 'concurrent', 'generate_cmd',
+             'plot_data', 'startup']
+
+def load_control():
+    """Import lfi-3751-control as a module (main() is not run)."""
+    loader = SourceFileLoader('lfi_3751_control', control_path)
+    module = module_from_spec(spec_from_loader(loader.name, loader))
+    loader.exec_module(module)
+    return module
+
+def summarize(latencies, elapsed = None):
+    """Return count, rate and latency percentiles for a list of seconds."""
+    latencies = sorted(latencies)
+    count = len(latencies)
+    if elapsed is None:
+        elapsed = sum(latencies)
+
+    def percentile(p):
+        if not latencies:
+            return None
+        return latencies[min(count - 1, int(round(p / 100 * (count - 1))))]
+
+    return {
+        'count': count,
+        'seconds': elapsed,
+        'ops_per_second': count / elapsed if elapsed > 0 else None,
+        'mean': sum(latencies) / count if count else None,
+        'p50': percentile(50),
+        'p95': percentile(95),
+        'p99': percentile(99),
+        'max': latencies[-1] if latencies else None,
+    }
+
+def timed(func, count):
+    """Call func count times, return the latency of each call."""
+    latencies = []
+    for i in range(count):
+        start = perf_counter()
+        func()
+        latencies.append(perf_counter() - start)
+    return latencies
+
+class Testbed():
+    """An emulator and a SerialDaemon in child processes, in a temp dir."""
+
+    def __init__(self, units = ('01',), emulator_options = {},
+                 daemon_options = {}):
+        self.units = units
+        self.emulator_options = emulator_options
+        self.daemon_options = daemon_options
+        self.pids = []
+
+    def __enter__(self):
+        self.dir = tempfile.mkdtemp(prefix = 'lfi-bench-')
+        self.emulator = Emulator(
+            units = [int(unit) for unit in self.units],
+            **self.emulator_options)
+        self.port = self.emulator.open()
+        self.pids.append(self.__fork(self.emulator.serve_forever))
+
+        self.control = load_control()
+        self.control.socket_dir = self.dir
+        self.control.pidfile_dir = self.dir
+        for unit in self.units:
+            self.pids.append(self.__fork(self.__serve, unit))
+        for unit in self.units:
+            self.__wait_for(self.control.get_socket(unit))
+        return self
+
+    def __exit__(self, *exc):
+        for pid in reversed(self.pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.emulator.close()
+        shutil.rmtree(self.dir, ignore_errors = True)
+
+    def __serve(self, unit):
+        from seriald import SerialDaemon
+
+        config_file = os.path.join(self.dir, 'seriald.conf')
+        open(config_file, 'a').close()
+        options = {
+            'name': 'lfi-bench',
+            'config_file': config_file,
+            'log_file': os.path.join(self.dir, 'seriald.log'),
+            'pidfile_path': self.control.get_pidfile(unit),
+            'socket_path': self.control.get_socket(unit),
+            'detach_process': False,
+            'working_directory': self.dir,
+            'port': self.port,
+            'baudrate': self.control.baudrate,
+            'bytesize': self.control.bytesize,
+            'parity': self.control.parity,
+            'stopbits': self.control.stopbits,
+            'xonxoff': self.control.xonxoff,
+            'timeout': self.control.serial_timeout,
+            'serial_retries': self.control.serial_retries,
+            'adaptive_timeout': self.control.adaptive_timeout,
+            'reply_terminator': self.control.reply_terminator.encode(
+                self.control.data_encoding),
+            'command_labels': self.control.codec.command_labels,
+        }
+        options.update(self.daemon_options)
+        SerialDaemon(**options).start()
+
+    def __fork(self, func, *args):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                func(*args)
+            finally:
+                os._exit(0)
+        return pid
+
+    def __wait_for(self, path, timeout = 10):
+        start = time()
+        while not os.path.exists(path):
+            if time() - start > timeout:
+                raise RuntimeError('Daemon did not create {path}'.format(
+                    path = path))
+            sleep(0.01)
+
+def bench_oneshot(bed, args):
+    ctl = bed.control
+    unit = bed.units[0]
+    return summarize(timed(
+        lambda: ctl.send_cmd('ACT_T', '', unit, verbose = False),
+        args.count))
+
+def bench_persistent(bed, args):
+    ctl = bed.control
+    unit = bed.units[0]
+    soc = ctl.connect_to_socket(unit)
+    try:
+        return summarize(timed(
+            lambda: ctl.send_cmd('ACT_T', '', unit, soc = soc,
+                                 verbose = False),
+            args.count))
+    finally:
+        soc.close()
+
+def bench_batch(bed, args):
+    ctl = bed.control
+    unit = bed.units[0]
+    query = [(cmd, '') for cmd in args.query]
+    soc = ctl.connect_to_socket(unit)
+    try:
+        result = summarize(timed(
+            lambda: ctl.send_cmds(query, unit, soc = soc, verbose = False),
+            args.count))
+    finally:
+        soc.close()
+    result['commands_per_request'] = len(query)
+    return result
+
+def _concurrent_worker(control, unit, count, queue):
+    soc = control.connect_to_socket(unit)
+    queue.put(timed(
+        lambda: control.send_cmd('ACT_T', '', unit, soc = soc,
+                                 verbose = False),
+        count))
+    soc.close()
+
+def bench_concurrent(bed, args):
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    workers = [context.Process(
+        target = _concurrent_worker,
+        args = (bed.control, bed.units[i % len(bed.units)],
+                args.count, queue))
+               for i in range(args.clients)]
+
+    start = perf_counter()
+    for worker in workers:
+        worker.start()
+    latencies = []
+    for worker in workers:
+        latencies.extend(queue.get())
+    elapsed = perf_counter() - start
+    for worker in workers:
+        worker.join()
+
+    result = summarize(latencies, elapsed)
+    result['clients'] = args.clients
+    return result
+
+def bench_generate_cmd(bed, args):
+    ctl = bed.control
+    unit = bed.units[0]
+    commands = [('ACT_T', ''), ('TE_I', ''), ('SET_T', '25.5'), ('P', 'auto_s')]
+    latencies = timed(
+        lambda: [ctl.generate_cmd(cmd, value, unit)
+                 for cmd, value in commands],
+        args.count)
+    return summarize([latency / len(commands) for latency in latencies])
+
+def bench_plot_data(bed, args):
+    ctl = bed.control
+    window = ctl.DataWindow(args.window)
+    rng = random.Random(0)
+    points = [(float(i), rng.gauss(25, 0.1)) for i in range(args.points)]
+
+    it = iter(points)
+    appends = timed(lambda: window.append(*next(it)), len(points))
+
+    def lookup():
+        xmin = rng.uniform(window.xdata[0], window.xdata[-1])
+        window.searchsorted((xmin, xmin + (window.xdata[-1] - xmin) / 2))
+    lookups = timed(lookup, args.lookups)
+
+    return {
+        'window': args.window,
+        'append': summarize(appends),
+        'searchsorted': summarize(lookups),
+    }
+
+def bench_startup(bed, args):
+    if os.geteuid() != 0:
+        return {'skipped': 'lfi-3751-control must be run as root'}
+
+    ctl = bed.control
+    unit = bed.units[0]
+    config_file = os.path.join(bed.dir, 'control.conf')
+    with open(config_file, 'w') as conf:
+        conf.write('pidfile_dir = {dir}\nsocket_dir = {dir}\n'.format(
+            dir = bed.dir))
+        conf.write('socket_framing = {framing}\n'.format(
+            framing = ctl.socket_framing))
+        conf.write('unit_address = {unit}\n'.format(unit = int(unit)))
+    script = os.path.join(bed.dir, 'commands')
+    with open(script, 'w') as commands:
+        commands.write('ACT_T\n' * args.batch_lines)
+
+    def run(*command_args):
+        subprocess.run(
+            [sys.executable, control_path] + list(command_args) +
+            ['--config', config_file],
+            stdout = subprocess.DEVNULL, check = True)
+
+    batch = summarize(timed(lambda: run('batch', script), args.runs))
+    batch['commands'] = args.batch_lines
+    return {
+        'interpreter': summarize(timed(
+            lambda: subprocess.run([sys.executable, '-c', 'pass'],
+                                   check = True),
+            args.runs)),
+        'single': summarize(timed(lambda: run('single', 'ACT_T'), args.runs)),
+        'batch': batch,
+    }
+
+def compare(results, baseline, tolerance):
+    """Return scenarios whose p50 is more than tolerance slower."""
+    regressions = []
+    for name, result in results.items():
+        for key, old in _flatten(baseline.get(name, {})):
+            new = dict(_flatten(result)).get(key)
+            if key.endswith('p50') and old and new \
+               and new > old * (1 + tolerance):
+                regressions.append('{name}.{key}: {old:.6f} -> {new:.6f}'.format(
+                    name = name, key = key, old = old, new = new))
+    return regressions
+
+def _flatten(result, prefix = ''):
+    for key, value in result.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, prefix + key + '.')
+        else:
+            yield prefix + key, value
+
+def main():
+    ap = argparse.ArgumentParser(
+        description = 'Benchmark lfi-3751-control against an emulated device.')
+    ap.add_argument('scenarios', nargs = '*', metavar = 'SCENARIO',
+                    help = 'scenarios to run: {names} (default: all)'.format(
+                        names = ', '.join(scenarios)))
+    ap.add_argument('-n', '--count', type = int, default = 200,
+                    help = 'operations per scenario (default: 200)')
+    ap.add_argument('-c', '--clients', type = int, default = 4,
+                    help = 'clients for the concurrent scenario (default: 4)')
+    ap.add_argument('-q', '--query', nargs = '+',
+                    default = ['ACT_T', 'TE_I', 'TE_V'],
+                    help = 'commands for the batch scenario ' + \
+                    '(default: ACT_T TE_I TE_V)')
+    ap.add_argument('--window', type = int, default = 500,
+                    help = 'plot window size (default: 500)')
+    ap.add_argument('--points', type = int, default = 20000,
+                    help = 'points appended to the plot window ' + \
+                    '(default: 20000)')
+    ap.add_argument('--lookups', type = int, default = 200,
+                    help = 'range lookups in the plot window (default: 200)')
+    ap.add_argument('--runs', type = int, default = 20,
+                    help = 'processes started in the startup scenario ' + \
+                    '(default: 20)')
+    ap.add_argument('--batch-lines', type = int, default = 100,
+                    help = 'commands per batch in the startup scenario ' + \
+                    '(default: 100)')
+    ap.add_argument('--delay', type = float, default = 0.0,
+                    help = 'emulated device reply delay in seconds')
+    ap.add_argument('--byte-time', type = float, default = 0.0,
+                    help = 'emulated device time per byte in seconds')
+    ap.add_argument('--framing', choices = ['binary', 'text'],
+                    default = None, help = 'socket framing of the client')
+    ap.add_argument('-o', '--output', type = str, default = None,
+                    metavar = 'FILE', help = 'write results to FILE')
+    ap.add_argument('--compare', type = str, default = None,
+                    metavar = 'FILE',
+                    help = 'exit with status 1 if any p50 is slower ' + \
+                    'than in results FILE')
+    ap.add_argument('--tolerance', type = float, default = 0.2,
+                    help = 'allowed slowdown for --compare (default: 0.2)')
+    args = ap.parse_args()
+
+    selected = args.scenarios or scenarios
+    for name in selected:
+        if name not in scenarios:
+            ap.error('unknown scenario: {name}'.format(name = name))
+
+    results = {}
+    with Testbed(emulator_options = {
+            'delay': args.delay,
+            'byte_time': args.byte_time}) as bed:
+        if args.framing is not None:
+            bed.control.socket_framing = args.framing
+        for name in selected:
+            results[name] = globals()['bench_' + name](bed, args)
+
+    report = {
+        'date': strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'options': {key: value for key, value in vars(args).items()
+                    if key not in ('output', 'compare', 'scenarios')},
+        'results': results,
+    }
+    text = json.dumps(report, indent = 2, sort_keys = True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, 'r') as baseline:
+            regressions = compare(results, json.load(baseline)['results'],
+                                  args.tolerance)
+        for regression in regressions:
+            print('Regression: {msg}'.format(msg = regression),
+                  file = sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
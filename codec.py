@@ -0,0 +1,336 @@
+###############################################################################
+#
+# Copyright (C) 2015 Aleksandrina Nikolova <aayla.secura.1138@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+# Encoding of commands to and decoding of replies from LFI-3751 units
+
+"""Encoder/decoder for the LFI-3751 serial protocol.
+
+A Codec is built once from a table of device commands in the format of
+device_commands in lfi3751.py; everything that can be worked out in
+advance (command codes, value formats, allowed ranges and aliases) is
+prepared then, and frames for read commands are cached per unit, so that
+encoding a read in a polling loop is a dictionary lookup.
+
+Value formats are strings in which '+' stands for a sign, 'D' for a digit,
+'A' for a letter, digit, '_' or '-' and any other character for itself.
+
+Exported classes:
+Codec: encodes commands and decodes replies.
+CachePolicy: tells SerialDaemon which replies it may cache, see seriald.py.
+CodecError: raised for invalid commands or values.
+
+Exported functions:
+fcs: the frame check sequence of a frame.
+"""
+
+from functools import reduce
+from operator import xor
+
+class CodecError(ValueError):
+    pass
+
+def fcs(data):
+    """Return the XOR of all bytes in data (bytes or ASCII str)."""
+    if isinstance(data, str):
+        data = data.encode('ascii')
+    return reduce(xor, data, 0)
+
+def matches_format(value, value_format):
+    """Check if value (str) is in value_format, see module documentation."""
+    if len(value) != len(value_format):
+        return False
+
+    for char, format_char in zip(value, value_format):
+        if format_char == '+':
+            if char not in '+-':
+                return False
+        elif format_char == 'D':
+            if not char.isdigit():
+                return False
+        elif format_char == 'A':
+            if not (char.isalnum() or char in '_-'):
+                return False
+        elif char != format_char:
+            return False
+    return True
+
+class _Command():
+    # everything needed to encode one command, worked out once
+    def __init__(self, name, spec):
+        self.name = name
+        self.code = spec['code']
+        self.read_format = spec['read'].get('format')
+        self.write_format = spec['write'].get('format')
+        self.aliases = {alias.upper(): value for alias, value in
+                        spec['write'].get('alias', {}).items()}
+        self.limits = None
+        if 'range' in spec['write']:
+            self.limits = tuple(
+                float(limit) for limit in spec['write']['range'].split())
+        if self.read_format is not None:
+            self.read_value = self.read_format.replace(
+                'D', '0').replace('A', '0')
+
+class Codec():
+    """Encodes commands to and decodes replies from LFI-3751 units.
+
+    Accepted options for the constructor:
+
+    device_commands
+        The command table, see lfi3751.py.
+
+    unit_type, cmd_char, read_char, write_char
+        The unit type, start character of commands and command type
+        characters for reads and writes.
+
+    reply_length
+        Length of a full reply from the device.
+
+    first_data_char, last_data_char
+        1-based positions of the first and last character of the data
+        field in a full reply.
+
+    check_fcs
+        If True, full replies whose frame check sequence (the 2 hex digits
+        following the data field, the XOR of all bytes preceding them) does
+        not match are rejected.
+    """
+
+    def __init__(
+            self,
+            device_commands,
+            unit_type = '1',
+            cmd_char = '!',
+            read_char = '1',
+            write_char = '2',
+            reply_length = 21,
+            first_data_char = 10,
+            last_data_char = 17,
+            check_fcs = True
+    ):
+        self.commands = {name: _Command(name, spec)
+                         for name, spec in device_commands.items()}
+        self.unit_type = unit_type
+        self.cmd_char = cmd_char
+        self.read_char = read_char
+        self.write_char = write_char
+        self.reply_length = reply_length
+        self.data_start = first_data_char - 1
+        self.data_end = last_data_char
+        self.check_fcs = check_fcs
+        self.read_frames = {}       # (unit, command) -> encoded read frame
+        self.names = {spec.code.encode('ascii'): name
+                      for name, spec in self.commands.items()}
+
+    def encode(self, command, value, unit):
+        """Return the frame (bytes) for command with value for unit.
+
+        An empty value means a read. Raises CodecError if the command or
+        value are not valid.
+        """
+        if not value:
+            try:
+                return self.read_frames[unit, command]
+            except KeyError:
+                pass
+
+        try:
+            spec = self.commands[command]
+        except KeyError:
+            raise CodecError('Invalid device command!')
+
+        if value:
+            cmd_type = self.write_char
+            value = self.__check_value(spec, value)
+        else:
+            cmd_type = self.read_char
+            if spec.read_format is None:
+                raise CodecError(
+                    'read is not a valid operation for command {command}'.format(
+                        command = command))
+            value = spec.read_value
+
+        # command to the device must be in the following format
+        frame = '{char}{unit_type}{unit_address}{cmd_type}{cmd_code}{value}'.format(
+            char = self.cmd_char,
+            unit_type = self.unit_type,
+            unit_address = unit,
+            cmd_type = cmd_type,
+            cmd_code = spec.code,
+            value = value
+        ).encode('ascii')
+        # append the FCS
+        frame += '{fcs:0>2X}'.format(fcs = fcs(frame)).encode('ascii')
+
+        if cmd_type == self.read_char:
+            self.read_frames[unit, command] = frame
+        return frame
+
+    def expects_reply(self, command):
+        """Whether the device replies to command."""
+        return self.commands[command].read_format is not None
+
+    def decode(self, command, value, reply):
+        """Return the data field (str) of reply (bytes) to command.
+
+        Returns None if the reply is not valid. A full reply is only checked
+        for its FCS (if check_fcs is set). In a partial reply the data field
+        is looked for and accepted if it is found exactly once.
+        """
+        spec = self.commands[command]
+        if len(reply) == self.reply_length:
+            if self.check_fcs:
+                try:
+                    reply_fcs = int(reply[self.data_end : self.data_end + 2],
+                                    16)
+                except ValueError:
+                    return None
+                if reply_fcs != fcs(reply[:self.data_end]):
+                    return None
+            return reply[self.data_start : self.data_end].decode(
+                'ascii', 'replace')
+
+        # data received is partial, search for data field
+        if value:
+            value_format = spec.write_format
+        else:
+            value_format = spec.read_format
+        reply = reply.decode('ascii', 'replace')
+        length = len(value_format)
+        found = None
+        i = 0
+        while i + length <= len(reply):
+            if matches_format(reply[i : i + length], value_format):
+                if found is not None:
+                    # ambiguous
+                    return None
+                found = reply[i : i + length]
+                i += length
+            else:
+                i += 1
+        return found
+
+    def parse_frame(self, frame):
+        """Return (unit, command type, command code) of an encoded frame.
+
+        All three are bytes. Returns None if frame is not a command.
+        """
+        if len(frame) != 17 or frame[0:1] != self.cmd_char.encode('ascii'):
+            return None
+        return frame[2:4], frame[4:5], frame[5:7]
+
+    def command_labels(self, frame):
+        """Return the unit and command name of an encoded frame.
+
+        Meant as SerialDaemon's command_labels, returns a dictionary with
+        'unit' and 'command' (str), or None if frame is not a command.
+        """
+        parsed = self.parse_frame(frame)
+        if parsed is None:
+            return None
+
+        unit, cmd_type, code = parsed
+        return {
+            'unit': unit.decode('ascii', 'replace'),
+            'command': self.names.get(code, code.decode('ascii', 'replace')),
+        }
+
+    def __check_value(self, spec, value):
+        if spec.write_format is None:
+            raise CodecError(
+                'write is not a valid operation for command {command}'.format(
+                    command = spec.name))
+
+        # check if it is an alias
+        try:
+            return spec.aliases[value.upper()]
+        except KeyError:
+            pass
+
+        if spec.write_format == '+DDD.DDD':
+            # value should be numeric
+            # accept any valid number and convert it to the right format
+            try:
+                number = float(value)
+            except ValueError:
+                number = None
+            else:
+                value = '{sign}{value:0>7.3f}'.format(
+                    sign = ('-' if value.startswith('-') else '+'),
+                    value = abs(number))
+
+        if not matches_format(value, spec.write_format):
+            raise CodecError(
+                ('{value} is neither a known alias nor in the ' +
+                 'allowed format for command {command}').format(
+                     command = spec.name,
+                     value = value))
+
+        # then check if it is in the allowed range
+        if spec.limits is not None:
+            low_limit, high_limit = spec.limits
+            if not low_limit <= float(value) <= high_limit:
+                raise CodecError(
+                    ('{value} is not within the allowed numerical range ' +
+                     'for command {command}').format(
+                         command = spec.name,
+                         value = value))
+
+        return value
+
+class CachePolicy():
+    """Which replies SerialDaemon may cache and for how long.
+
+    ttls maps command names to the number of seconds a reply to a read of
+    that command may be reused for; commands not in it are never cached.
+    Any write to a unit invalidates everything cached for that unit, since
+    a write to one register (e.g. SET_T, OUTPUT or P) can change the value
+    of most others (ACT_T, TE_I, TE_V, OUTPUT, ...).
+    """
+
+    def __init__(self, codec, ttls):
+        self.codec = codec
+        self.read_char = codec.read_char.encode('ascii')
+        self.ttls = {}
+        for command, ttl in ttls.items():
+            if ttl > 0:
+                self.ttls[codec.commands[command].code.encode('ascii')] = ttl
+
+    def cache_key(self, data):
+        """Return (key, ttl) if the reply to data may be cached, else None."""
+        parsed = self.codec.parse_frame(data)
+        if parsed is None:
+            return None
+
+        unit, cmd_type, code = parsed
+        if cmd_type != self.read_char or code not in self.ttls:
+            return None
+        return (unit, code), self.ttls[code]
+
+    def invalidated_keys(self, data, keys):
+        """Return those of the cached keys which data makes stale."""
+        parsed = self.codec.parse_frame(data)
+        if parsed is None:
+            # unknown data, the device may have changed in any way
+            return list(keys)
+
+        unit, cmd_type, code = parsed
+        if cmd_type == self.read_char:
+            return []
+        return [key for key in keys if key[0] == unit]
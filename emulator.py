@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Copyright (C) 2015 Aleksandrina Nikolova <aayla.secura.1138@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+# An emulator of LFI-3751 temperature controllers on a pseudo-terminal
+
+"""LFI-3751 temperature controller emulator on a pseudo-terminal.
+
+The emulator opens a pty and answers commands written to its slave end the
+way one or more LFI-3751 units sharing a line would. Commands are 17 bytes:
+    !<unit type><address:2><1|2><code:2><value:8><FCS:2>
+where 1 is a read and 2 is a write and FCS is the XOR of all preceding bytes
+in upper case hex. Replies are 21 bytes:
+    @<unit type><address:2><1|2><code:2><error:2><value:8><FCS:2>\\r\\n
+with the FCS computed over the 17 bytes preceding it. Commands for addresses
+which are not emulated, with a wrong unit type or FCS, are ignored, like on a
+shared line. HALT and LOCAL are never answered.
+
+Run it as a script to get a pty that can be given to lfi-3751-control as the
+device, e.g.:
+    emulator.py --unit 1 --unit 2 --link /tmp/ttyLFI0
+    lfi-3751-control start --unit 1 --device /tmp/ttyLFI0
+
+Exported classes:
+Unit: the registers and thermal model of a single controller.
+Emulator: serves any number of units on one pty.
+"""
+
+import argparse
+import math
+import os
+import random
+import select
+import signal
+import sys
+import tty
+from time import monotonic, sleep
+
+CMD_LENGTH = 17
+REPLY_LENGTH = 21
+UNIT_TYPE = '1'
+READ_CHAR = '1'
+WRITE_CHAR = '2'
+
+# error codes in replies
+ERROR_NONE = '00'
+ERROR_CODE = '01'           # unknown command code
+ERROR_VALUE = '02'          # malformed value
+
+# command codes
+ACT_T = '01'
+ACT_R = '02'
+SET_T = '03'
+SET_R = '04'
+TE_I = '05'
+TE_V = '06'
+LIM_I_POS = '07'
+LIM_I_NEG = '08'
+AUX_T = '09'
+P = '10'
+I = '11'
+D = '12'
+OUTPUT = '51'
+HALT = '52'
+LOCAL = '53'
+# registers which are only stored
+PLAIN_REGISTERS = ['21', '22', '23', '24', '25', '26', '31', '32']
+
+def fcs(data):
+    """Return the XOR of all bytes in data as 2 upper case hex digits."""
+    value = 0
+    for byte in data:
+        value ^= byte
+    return '{fcs:0>2X}'.format(fcs = value).encode('ascii')
+
+def format_value(value):
+    """Format a number as +DDD.DDD."""
+    return '{sign}{value:0>7.3f}'.format(
+        sign = '-' if value < 0 else '+',
+        value = min(abs(value), 999.999))
+
+class Unit():
+    """The registers and thermal model of a single controller.
+
+    While the output is on, ACT_T approaches SET_T exponentially with time
+    constant tau (in seconds), otherwise it approaches the ambient
+    temperature. Gaussian noise with standard deviation noise (in C) is added
+    to every reading. TE_I is proportional to the remaining difference and
+    limited by LIM_I_POS and LIM_I_NEG.
+    """
+
+    def __init__(
+            self,
+            address,
+            ambient = 25.0,
+            tau = 10.0,
+            noise = 0.0,
+            rng = None
+    ):
+        self.address = address
+        self.ambient = ambient
+        self.tau = tau
+        self.noise = noise
+        self.rng = rng or random.Random()
+        self.output = True
+        self.act_t = ambient
+        self.last_update = monotonic()
+        self.registers = {
+            SET_T: ambient,
+            SET_R: 10.0,
+            LIM_I_POS: 2.0,
+            LIM_I_NEG: -2.0,
+            AUX_T: ambient,
+            P: 30.0,
+            I: 1.0,
+            D: 1.0,
+        }
+        for code in PLAIN_REGISTERS:
+            self.registers[code] = 0.0
+
+    def update(self, now = None):
+        """Advance the thermal model to now (monotonic time)."""
+        if now is None:
+            now = monotonic()
+        elapsed = max(0.0, now - self.last_update)
+        self.last_update = now
+
+        if self.output:
+            target = self.registers[SET_T]
+        else:
+            target = self.ambient
+        if self.tau > 0:
+            self.act_t = target + (self.act_t - target) * math.exp(
+                -elapsed / self.tau)
+        else:
+            self.act_t = target
+
+    def te_i(self):
+        if not self.output:
+            return 0.0
+        current = (self.registers[SET_T] - self.act_t) * \
+                  self.registers[P] / 10.0
+        return max(self.registers[LIM_I_NEG],
+                   min(self.registers[LIM_I_POS], current))
+
+    def read(self, code):
+        """Return the value of register code, None if it is unknown."""
+        self.update()
+        if code == ACT_T:
+            return self.act_t + self.rng.gauss(0, self.noise)
+        elif code == ACT_R:
+            # 10k thermistor, beta model
+            return 10.0 * math.exp(3950.0 * (
+                1 / (self.act_t + 273.15) - 1 / 298.15))
+        elif code == TE_I:
+            return self.te_i()
+        elif code == TE_V:
+            return self.te_i() * 2.0
+        elif code == OUTPUT:
+            # +0<AE><AS>.<TL><IS><OS>
+            return (self.registers[I] > 0) * 0.01 + self.output * 0.001
+        return self.registers.get(code)
+
+    def write(self, code, value):
+        """Set register code, return the new value, None if unknown."""
+        self.update()
+        if code == OUTPUT:
+            self.output = value != 0
+            return self.read(OUTPUT)
+        elif code in (HALT, LOCAL):
+            if code == HALT:
+                self.output = False
+            return value
+        elif code in self.registers:
+            self.registers[code] = value
+            return value
+        return None
+
+class Emulator():
+    """Serves any number of Unit objects on one pseudo-terminal.
+
+    Accepted options for the constructor:
+
+    units
+        Unit objects or unit addresses (for which a Unit with default
+        options is created).
+
+    delay
+        Seconds to wait between receiving a command and replying.
+
+    byte_time
+        Seconds to wait after writing each byte of a reply, e.g. 10 / baud
+        rate to emulate the speed of the line.
+
+    drop_rate
+        Probability that a reply is not sent at all.
+
+    partial_rate
+        Probability that only a random part of a reply is sent.
+
+    seed
+        Seed for the random number generator used for the above.
+
+    Call open() to create the pty, serve_forever() to answer commands until
+    stop() is called (from another thread or a signal handler) and close()
+    to release the pty.
+    """
+
+    def __init__(
+            self,
+            units = (1,),
+            delay = 0.0,
+            byte_time = 0.0,
+            drop_rate = 0.0,
+            partial_rate = 0.0,
+            seed = None
+    ):
+        self.rng = random.Random(seed)
+        self.units = {}
+        for unit in units:
+            if not isinstance(unit, Unit):
+                unit = Unit(int(unit), rng = self.rng)
+            self.units[unit.address] = unit
+        self.delay = delay
+        self.byte_time = byte_time
+        self.drop_rate = drop_rate
+        self.partial_rate = partial_rate
+        self.master = None
+        self.slave = None
+        self.link = None
+        self.running = False
+        self.commands = 0           # number of commands answered
+
+    def open(self, link = None):
+        """Create the pty and return the path to its slave end.
+
+        If link is given, a symbolic link to the slave is created there.
+        """
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        path = os.ttyname(self.slave)
+        if link is not None:
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(path, link)
+            self.link = link
+        return path
+
+    def close(self):
+        if self.link is not None and os.path.islink(self.link):
+            os.remove(self.link)
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = self.link = None
+
+    def stop(self):
+        self.running = False
+
+    def serve_forever(self, poll_interval = 0.1):
+        buf = bytearray()
+        self.running = True
+        while self.running:
+            if not select.select([self.master], [], [], poll_interval)[0]:
+                continue
+            try:
+                buf.extend(os.read(self.master, 1024))
+            except OSError:
+                # slave end was closed
+                sleep(poll_interval)
+                continue
+
+            while True:
+                # skip noise before the start of a command
+                start = buf.find(b'!')
+                if start < 0:
+                    del buf[:]
+                    break
+                del buf[:start]
+                if len(buf) < CMD_LENGTH:
+                    break
+
+                cmd = bytes(buf[:CMD_LENGTH])
+                reply = self.handle(cmd)
+                if reply is None:
+                    # not a valid command, resynchronise on the next !
+                    del buf[:1]
+                    continue
+
+                del buf[:CMD_LENGTH]
+                if reply:
+                    self.send(reply)
+
+    def handle(self, cmd):
+        """Return the reply to cmd, b'' if there is none, None if invalid."""
+        if cmd[15:17] != fcs(cmd[:15]):
+            return None
+
+        text = cmd.decode('ascii', 'replace')
+        unit_type, address, cmd_type, code, value = (
+            text[1], text[2:4], text[4], text[5:7], text[7:15])
+        if unit_type != UNIT_TYPE or cmd_type not in (READ_CHAR, WRITE_CHAR):
+            return None
+        try:
+            unit = self.units[int(address)]
+        except (KeyError, ValueError):
+            # some other unit on the line
+            return b''
+
+        self.commands += 1
+        if code in (HALT, LOCAL):
+            if cmd_type == WRITE_CHAR:
+                unit.write(code, 0.0)
+            return b''
+
+        error = ERROR_NONE
+        if cmd_type == READ_CHAR:
+            result = unit.read(code)
+        else:
+            try:
+                result = unit.write(code, float(value))
+            except ValueError:
+                error = ERROR_VALUE
+                result = 0.0
+        if result is None:
+            error = ERROR_CODE
+            result = 0.0
+
+        reply = '@{type}{address}{cmd_type}{code}{error}{value}'.format(
+            type = UNIT_TYPE,
+            address = address,
+            cmd_type = cmd_type,
+            code = code,
+            error = error,
+            value = format_value(result)).encode('ascii')
+        return reply + fcs(reply) + b'\r\n'
+
+    def send(self, reply):
+        if self.rng.random() < self.drop_rate:
+            return
+        if self.rng.random() < self.partial_rate:
+            reply = reply[:self.rng.randrange(1, len(reply))]
+
+        if self.delay:
+            sleep(self.delay)
+        if not self.byte_time:
+            os.write(self.master, reply)
+            return
+        for i in range(len(reply)):
+            os.write(self.master, reply[i : i + 1])
+            sleep(self.byte_time)
+
+def main():
+    ap = argparse.ArgumentParser(
+        description = 'Emulate LFI-3751 controllers on a pseudo-terminal.')
+    ap.add_argument('-u', '--unit', type = int, action = 'append',
+                    dest = 'units', metavar = 'ADDRESS',
+                    help = 'address of an emulated unit, may be repeated ' + \
+                    '(default: 1)')
+    ap.add_argument('-l', '--link', type = str, metavar = 'PATH',
+                    help = 'create a symbolic link to the pty at PATH')
+    ap.add_argument('--delay', type = float, default = 0.0,
+                    metavar = 'SECONDS',
+                    help = 'delay before each reply (default: 0)')
+    ap.add_argument('--byte-time', type = float, default = 0.0,
+                    metavar = 'SECONDS',
+                    help = 'delay after each byte of a reply (default: 0)')
+    ap.add_argument('--drop-rate', type = float, default = 0.0,
+                    metavar = 'P',
+                    help = 'probability of not replying (default: 0)')
+    ap.add_argument('--partial-rate', type = float, default = 0.0,
+                    metavar = 'P',
+                    help = 'probability of a truncated reply (default: 0)')
+    ap.add_argument('--tau', type = float, default = 10.0,
+                    metavar = 'SECONDS',
+                    help = 'thermal time constant (default: 10)')
+    ap.add_argument('--noise', type = float, default = 0.0, metavar = 'TEMP',
+                    help = 'standard deviation of ACT_T noise (default: 0)')
+    ap.add_argument('--seed', type = int, default = None,
+                    help = 'seed for the random number generator')
+    args = ap.parse_args()
+
+    rng = random.Random(args.seed)
+    emulator = Emulator(
+        units = [Unit(address, tau = args.tau, noise = args.noise, rng = rng)
+                 for address in (args.units or [1])],
+        delay = args.delay,
+        byte_time = args.byte_time,
+        drop_rate = args.drop_rate,
+        partial_rate = args.partial_rate,
+        seed = args.seed
+    )
+    signal.signal(signal.SIGTERM, lambda sig, frame: emulator.stop())
+    path = emulator.open(args.link)
+    print('Emulating unit(s) {units} on {path}'.format(
+        units = ', '.join(str(address) for address in sorted(emulator.units)),
+        path = args.link or path))
+    sys.stdout.flush()
+    try:
+        emulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,370 @@
+###############################################################################
+#
+# Copyright (C) 2015 Aleksandrina Nikolova <aayla.secura.1138@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+# Binary framing for the seriald socket protocol
+
+"""Length-prefixed binary framing for the seriald socket protocol.
+
+Every frame starts with a fixed size header:
+    <magic> <version> <type> <flags> <tag> <payload length>
+packed as HEADER (network byte order), followed by the payload. The magic
+byte is FRAME_MAGIC, which can never start a UTF-8 encoded text packet, so
+the daemon tells framed connections from text (legacy) ones by the first
+byte a client sends. The tag is chosen by the client and is copied to the
+reply, so that a late reply to a request that timed out is not mistaken for
+the reply to the next one.
+
+A MSG_REQUEST payload holds one or more entries, each being REQUEST_ENTRY
+(number of bytes to read from device, length of data) followed by the data
+to send to device. The MSG_REPLY payload holds one entry per request entry,
+each being REPLY_ENTRY (status, flags, length of data) followed, if flags
+has REPLY_CACHED set, by CACHE_AGE (milliseconds since the data was read
+from device) and then by the data read from device. MSG_DEVICE has no
+payload in a request and the device path in the reply. Statuses are the
+STATUS_* constants and flags the REPLY_* constants.
+
+A MSG_SUBSCRIBE payload is SUBSCRIBE (period in seconds) followed by
+entries as in MSG_REQUEST. The daemon then sends the entries to the device
+every period seconds and replies to each round with a MSG_SAMPLE carrying
+the tag of the MSG_SUBSCRIBE, whose payload is SAMPLE (time of the sample
+in seconds since the epoch) followed by entries as in MSG_REPLY, until it
+gets a MSG_UNSUBSCRIBE (no payload) with that tag or the connection is
+closed.
+
+MSG_STATS has no payload in a request and the daemon's metrics, a JSON
+object as described in metrics.py, in the reply.
+
+A MSG_PROFILE payload holds one or more steps, each being PROFILE_STEP
+(time of the step in seconds from the start of the profile, number of
+bytes to read from device, length of data) followed by the data to send
+to device, in the order of their times. The daemon runs the profile on its
+own clock, whether or not the client stays connected, and replies with a
+MSG_PROGRESS carrying the tag of the MSG_PROFILE when it is accepted,
+after every step and when it is finished. A MSG_PROGRESS payload holds one
+or more PROGRESS records (profile id, PROFILE_* state, steps done, number
+of steps, seconds into the profile, status of the last step, length of
+data) each followed by the data read from device for the last step. A
+MSG_PROFILE_CONTROL payload is PROFILE_CONTROL (a PROFILE_* action and the
+id of a profile, 0 for all of them) and is replied to with a MSG_PROGRESS
+holding a record for every profile it applied to. Holding a profile stops
+its clock until it is resumed.
+
+Exported classes:
+FrameReader: reassembles frames read from a socket into a reusable buffer.
+FramedSocket: a socket.socket which can send and receive whole frames.
+FramingError: raised on malformed frames.
+"""
+
+import socket
+import struct
+from collections import deque
+
+FRAME_MAGIC = 0xA5          # a UTF-8 continuation byte, never starts text
+FRAME_VERSION = 1
+MAX_PAYLOAD = 1 << 24       # frames larger than this are rejected
+
+HEADER = struct.Struct('!BBBBHI')
+REQUEST_ENTRY = struct.Struct('!HH')
+REPLY_ENTRY = struct.Struct('!BBH')
+CACHE_AGE = struct.Struct('!I')
+SUBSCRIBE = struct.Struct('!d')
+SAMPLE = struct.Struct('!d')
+PROFILE_STEP = struct.Struct('!dHH')
+PROGRESS = struct.Struct('!HBIIdBH')
+PROFILE_CONTROL = struct.Struct('!BH')
+
+# message types
+MSG_ERROR = 0x00            # reply to an invalid request, payload is text
+MSG_DEVICE = 0x01           # request device path
+MSG_REQUEST = 0x02          # send data to device and read replies
+MSG_REPLY = 0x03            # reply to MSG_REQUEST
+MSG_SUBSCRIBE = 0x04        # send data to device periodically
+MSG_SAMPLE = 0x05           # replies from one period of a MSG_SUBSCRIBE
+MSG_UNSUBSCRIBE = 0x06      # cancel a MSG_SUBSCRIBE
+MSG_STATS = 0x07            # request the daemon's metrics
+MSG_PROFILE = 0x08          # send data to device at given times
+MSG_PROGRESS = 0x09         # state of MSG_PROFILE profiles
+MSG_PROFILE_CONTROL = 0x0A  # query, hold, resume or abort profiles
+
+# status of each entry in a reply
+STATUS_OK = 0               # full reply read from device
+STATUS_NO_REPLY = 1         # no reply was requested
+STATUS_PARTIAL = 2          # reply is shorter than requested
+STATUS_DISCARDED = 3        # reply was short and the daemon is strict
+
+# state of a profile in a progress record
+PROFILE_RUNNING = 0
+PROFILE_HELD = 1
+PROFILE_DONE = 2
+PROFILE_ABORTED = 3
+
+# actions of a MSG_PROFILE_CONTROL
+PROFILE_QUERY = 0
+PROFILE_HOLD = 1
+PROFILE_RESUME = 2
+PROFILE_ABORT = 3
+
+# flags of each entry in a reply
+REPLY_CACHED = 0x01         # reply was not read from device just now
+
+class FramingError(Exception):
+    pass
+
+def pack_frame(msg_type, payload = b'', flags = 0, tag = 0):
+    return HEADER.pack(FRAME_MAGIC, FRAME_VERSION, msg_type, flags, tag,
+                       len(payload)) + payload
+
+def pack_request(entries):
+    """Pack (reply_length, data) pairs into a MSG_REQUEST payload."""
+    payload = bytearray()
+    for reply_length, data in entries:
+        payload.extend(REQUEST_ENTRY.pack(reply_length, len(data)))
+        payload.extend(data)
+    return bytes(payload)
+
+def unpack_request(payload):
+    """Return the (reply_length, data) pairs in a MSG_REQUEST payload."""
+    entries = []
+    offset = 0
+    while offset < len(payload):
+        try:
+            reply_length, length = REQUEST_ENTRY.unpack_from(payload, offset)
+        except struct.error:
+            raise FramingError('Truncated request entry')
+        offset += REQUEST_ENTRY.size
+        if offset + length > len(payload):
+            raise FramingError('Truncated request entry')
+        entries.append((reply_length, payload[offset : offset + length]))
+        offset += length
+    return entries
+
+def pack_reply(entries):
+    """Pack (status, flags, data, age) into a MSG_REPLY payload.
+
+    age is the age of cached data in seconds and is only used if flags has
+    REPLY_CACHED set.
+    """
+    payload = bytearray()
+    for status, flags, data, age in entries:
+        payload.extend(REPLY_ENTRY.pack(status, flags, len(data)))
+        if flags & REPLY_CACHED:
+            payload.extend(CACHE_AGE.pack(
+                min(int(age * 1000), 0xFFFFFFFF)))
+        payload.extend(data)
+    return bytes(payload)
+
+def unpack_reply(payload):
+    """Return (status, flags, data, age) of each entry in a MSG_REPLY.
+
+    age is in seconds, None unless flags has REPLY_CACHED set.
+    """
+    entries = []
+    offset = 0
+    while offset < len(payload):
+        status, flags, length = REPLY_ENTRY.unpack_from(payload, offset)
+        offset += REPLY_ENTRY.size
+        age = None
+        if flags & REPLY_CACHED:
+            age = CACHE_AGE.unpack_from(payload, offset)[0] / 1000
+            offset += CACHE_AGE.size
+        entries.append((status, flags, payload[offset : offset + length],
+                        age))
+        offset += length
+    return entries
+
+def pack_subscribe(period, entries):
+    """Pack the period and (reply_length, data) pairs of a MSG_SUBSCRIBE."""
+    return SUBSCRIBE.pack(period) + pack_request(entries)
+
+def unpack_subscribe(payload):
+    """Return the period and (reply_length, data) pairs of a MSG_SUBSCRIBE."""
+    try:
+        period, = SUBSCRIBE.unpack_from(payload)
+    except struct.error:
+        raise FramingError('Truncated subscription')
+    return period, unpack_request(payload[SUBSCRIBE.size:])
+
+def pack_sample(timestamp, entries):
+    """Pack the time and (status, flags, data, age) of a MSG_SAMPLE."""
+    return SAMPLE.pack(timestamp) + pack_reply(entries)
+
+def unpack_sample(payload):
+    """Return the time and (status, flags, data, age) of a MSG_SAMPLE."""
+    timestamp, = SAMPLE.unpack_from(payload)
+    return timestamp, unpack_reply(payload[SAMPLE.size:])
+
+def pack_profile(steps):
+    """Pack (time, reply_length, data) steps into a MSG_PROFILE payload."""
+    payload = bytearray()
+    for step_time, reply_length, data in steps:
+        payload.extend(PROFILE_STEP.pack(step_time, reply_length, len(data)))
+        payload.extend(data)
+    return bytes(payload)
+
+def unpack_profile(payload):
+    """Return the (time, reply_length, data) steps of a MSG_PROFILE."""
+    steps = []
+    offset = 0
+    while offset < len(payload):
+        try:
+            step_time, reply_length, length = PROFILE_STEP.unpack_from(
+                payload, offset)
+        except struct.error:
+            raise FramingError('Truncated profile step')
+        offset += PROFILE_STEP.size
+        if offset + length > len(payload):
+            raise FramingError('Truncated profile step')
+        steps.append((step_time, reply_length,
+                      payload[offset : offset + length]))
+        offset += length
+    return steps
+
+def pack_progress(records):
+    """Pack (id, state, done, total, elapsed, status, data) records."""
+    payload = bytearray()
+    for profile_id, state, done, total, elapsed, status, data in records:
+        payload.extend(PROGRESS.pack(profile_id, state, done, total, elapsed,
+                                     status, len(data)))
+        payload.extend(data)
+    return bytes(payload)
+
+def unpack_progress(payload):
+    """Return the records of a MSG_PROGRESS, as taken by pack_progress()."""
+    records = []
+    offset = 0
+    while offset < len(payload):
+        record = PROGRESS.unpack_from(payload, offset)
+        offset += PROGRESS.size
+        records.append(record[:-1] + (payload[offset : offset + record[-1]],))
+        offset += record[-1]
+    return records
+
+def pack_profile_control(action, profile_id = 0):
+    """Pack the action and profile id of a MSG_PROFILE_CONTROL."""
+    return PROFILE_CONTROL.pack(action, profile_id)
+
+def unpack_profile_control(payload):
+    """Return the action and profile id of a MSG_PROFILE_CONTROL."""
+    try:
+        return PROFILE_CONTROL.unpack(payload)
+    except struct.error:
+        raise FramingError('Invalid profile control')
+
+class FrameReader():
+    """Reassembles frames read from a socket.
+
+    Data is read with recv_into into a buffer allocated once (and grown only
+    if a frame does not fit in it), frames() then returns all complete frames
+    in the buffer and keeps any trailing partial frame for the next read.
+    """
+
+    def __init__(self, size = 1024):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+
+    def recv_from(self, soc):
+        """Read from soc into the buffer, return number of bytes read."""
+        if self.length == len(self.buffer):
+            self.__grow(2 * len(self.buffer))
+
+        nbytes = soc.recv_into(self.view[self.length:])
+        self.length += nbytes
+        return nbytes
+
+    def take(self):
+        """Return and discard everything in the buffer."""
+        data = bytes(self.view[:self.length])
+        self.length = 0
+        return data
+
+    def frames(self):
+        """Return (type, flags, tag, payload) of all complete frames."""
+        frames = []
+        offset = 0
+        while self.length - offset >= HEADER.size:
+            magic, version, msg_type, flags, tag, length = HEADER.unpack_from(
+                self.buffer, offset)
+            if magic != FRAME_MAGIC:
+                raise FramingError('Invalid frame start')
+            if version > FRAME_VERSION:
+                raise FramingError('Unsupported frame version {version}'.format(
+                    version = version))
+            if length > MAX_PAYLOAD:
+                raise FramingError('Frame too large')
+
+            end = offset + HEADER.size + length
+            if end > self.length:
+                # make sure the whole frame will fit
+                if end - offset > len(self.buffer):
+                    self.__grow(end - offset)
+                break
+
+            frames.append((msg_type, flags, tag,
+                           bytes(self.view[offset + HEADER.size : end])))
+            offset = end
+
+        if offset:
+            # move the partial frame to the beginning of the buffer
+            remaining = self.length - offset
+            self.view[:remaining] = self.view[offset : self.length]
+            self.length = remaining
+
+        return frames
+
+    def __grow(self, size):
+        self.view.release()
+        self.buffer.extend(bytes(size - len(self.buffer)))
+        self.view = memoryview(self.buffer)
+
+class FramedSocket(socket.socket):
+    """A socket.socket which sends and receives whole frames.
+
+    All methods of socket.socket are still available, but mixing recv()
+    with recv_frame() on the same socket will lose data.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reader = FrameReader()
+        self.pending_frames = deque()
+        self.tag = 0
+
+    def send_frame(self, msg_type, payload = b'', flags = 0):
+        """Send a frame with a new tag and return the tag."""
+        self.tag = (self.tag + 1) & 0xFFFF
+        self.sendall(pack_frame(msg_type, payload, flags, self.tag))
+        return self.tag
+
+    def recv_frame(self, tag = None):
+        """Return (type, flags, payload) of the next frame.
+
+        If tag is given, frames with a different tag are discarded. Raises
+        socket.timeout if nothing is received within the socket's timeout
+        and ConnectionResetError if the peer closes the connection.
+        """
+        while True:
+            while not self.pending_frames:
+                if self.reader.recv_from(self) == 0:
+                    raise ConnectionResetError('Connection closed by peer')
+                self.pending_frames.extend(self.reader.frames())
+
+            msg_type, flags, frame_tag, payload = self.pending_frames.popleft()
+            if tag is None or frame_tag == tag:
+                return msg_type, flags, payload
@@ -0,0 +1,910 @@
+###############################################################################
+#
+# Copyright (C) 2015 Aleksandrina Nikolova <aayla.secura.1138@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+# Client library for LFI-3751 units served by lfi-3751-control daemons
+
+"""Client library for LFI-3751 temperature controllers.
+
+Units are reached through the daemons started for them by lfi-3751-control
+(see seriald.py), over the binary socket framing (see framing.py), so that
+other programs can talk to any number of units without running the control
+script for every command:
+
+    async with LFIClient() as client:
+        temps = await client.read_all('ACT_T', [1, 2, 3])
+        await client.write(2, 'SET_T', 35.5, timeout = 2)
+
+    with SyncLFIClient() as client:
+        print(client.read(1, 'ACT_T'))
+
+A client keeps a connection to the daemon of each unit open once it has
+used it (and opens it again if the daemon went away), and any number of
+requests to any number of units may be awaited at the same time. Units are
+given by their address (1 to 99, as int or str); the aliases of the control
+script's configuration are not known here.
+
+Profiles, steps of commands sent at given times (e.g. a temperature ramp,
+see ramp_steps()), are run by the daemon on its own clock, so their timing
+does not depend on the client, which may even exit while they run. They
+are controlled by their id, which run_profile() yields with the progress.
+
+Values are returned as floats (every value of the LFI-3751 is in the format
++DDD.DDD), or None for commands the device does not reply to (HALT, LOCAL)
+or, where noted, for replies which were not valid. With raw set, the data
+fields are returned as the device sent them (str) instead.
+
+The command table of the device (device_commands) and the constants of its
+serial protocol are defined here as well, see codec.py for the format.
+
+Exported classes:
+LFIClient: asyncio client for any number of units.
+SyncLFIClient: the same for code not using asyncio.
+UnitConnection: a binary framed connection to the daemon of a unit.
+LFIError: raised when a unit cannot be talked to or gives no valid reply.
+LFITimeout: raised when a daemon does not reply in time.
+
+Exported functions:
+make_codec: return a codec.Codec for the LFI-3751.
+unit_address: return the address of a unit as used in commands.
+ramp_steps: return the profile steps of a linear ramp.
+"""
+
+# asyncio is only imported where it is needed, lfi-3751-control imports
+# this module for the command table on every run
+import os
+import threading
+from math import copysign
+
+from codec import Codec
+from framing import (
+    FRAME_MAGIC, pack_frame, pack_profile, pack_profile_control,
+    pack_request, pack_subscribe, unpack_progress, unpack_reply,
+    unpack_sample, MSG_PROFILE, MSG_PROFILE_CONTROL, MSG_PROGRESS,
+    MSG_REPLY, MSG_REQUEST, MSG_SAMPLE, MSG_SUBSCRIBE, MSG_UNSUBSCRIBE,
+    PROFILE_ABORT, PROFILE_ABORTED, PROFILE_DONE, PROFILE_HELD, PROFILE_HOLD,
+    PROFILE_QUERY, PROFILE_RESUME, PROFILE_RUNNING, STATUS_OK,
+    STATUS_PARTIAL)
+from framing import HEADER as FRAME_HEADER
+
+SOCKET_DIR = '/var/run'
+SOCKET_NAME = 'lfi-3751-control_<id>.socket'
+SOCKET_TIMEOUT = 1            # seconds the daemon may take per command
+
+PROFILE_STATES = {
+    PROFILE_RUNNING: 'running',
+    PROFILE_HELD: 'held',
+    PROFILE_DONE: 'done',
+    PROFILE_ABORTED: 'aborted',
+}
+PROFILE_ACTIONS = {
+    'query': PROFILE_QUERY,
+    'hold': PROFILE_HOLD,
+    'resume': PROFILE_RESUME,
+    'abort': PROFILE_ABORT,
+}
+
+min_unit_address = 1          # first allowed address
+max_unit_address = 99         # last allowed address
+unit_type = '1'	              # must be 1 (signifies temperature controller)
+cmd_char = '!'	              # commands to the device must start with !
+cmd_length = 15	              # and must be 15 bytes long excluding FCS
+reply_length = 21             # device sends 21 bytes of data
+reply_terminator = '\r\n'     # which end with CR LF
+first_data_char = 10          # bytes 10 to 17 are the data field in the reply
+last_data_char = 17
+read_char = '1'	              # 1 for read commands, 2 for write commands
+write_char = '2'
+temp_lims = '-199.900 +199.900'	# temperature limits
+res_lims = '+000.000 +499.900'	# resistance limits
+device_commands = {
+    'ACT_T': {
+	'code': '01',
+	'read': {
+	    'format': '+DDD.DDD'
+	},
+	'write': {}
+    },
+    'ACT_R': {
+	'code': '02',
+	'read': {
+	    'format': '+DDD.DDD'
+	},
+	'write': {}
+    },
+    'SET_T': {
+	'code': '03',
+        'read': {
+	    'format': '+DDD.DDD'
+        },
+	'write': {
+	    'format': '+DDD.DDD',
+	    'range': temp_lims
+	}
+    },
+    'SET_R': {
+	'code': '04',
+	'read': {
+	    'format': '+DDD.DDD'
+	},
+	'write': {
+	    'format': '+DDD.DDD',
+	    'range': res_lims
+	}
+    },
+    'TE_I': {
+	'code': '05',
+	'read': {
+	    'format': '+DDD.DDD'
+	},
+	'write': {}
+    },
+    'TE_V': {
+	'code': '06',
+	'read': {
+	    'format': '+DDD.DDD'
+	},
+	'write': {}
+    },
+    'LIM_I_POS': {
+	'code': '07',
+	'read': {
+	    'format': '+DDD.DDD'
+	},
+	'write': {
+	    'format': '+DDD.DDD',
+	    'range': '+000.000 +005.000'
+	}
+    },
+    'LIM_I_NEG': {
+	'code': '08',
+	'read': {
+	    'format': '+DDD.DDD'
+	},
+	'write': {
+	    'format': '+DDD.DDD',
+	    'range': '-005.000 +000.000'
+	}
+    },
+    'AUX_T': {
+	'code': '09',
+	'read': {
+	    'format': '+DDD.DDD'
+	},
+	'write': {}
+    },
+    'P': {
+	'code': '10',
+	'read': {
+	    'format': '+DDD.DDD'
+	},
+	'write': {
+	    'format': '+DDD.DDD',
+	    'range': '+000.000 +100.000',
+            'alias': {
+                'AUTO_S': '-002.000',
+                'AUTO_D': '-001.000'
+            }
+	}
+    },
+    'I': {
+	'code': '11',
+	'read': {
+	    'format': '+DDD.DDD'
+	},
+	'write': {
+	    'format': '+DDD.DDD',
+	    'range': '+000.400 +010.000',
+            'alias': {
+                'OFF': '+000.000'
+            }
+	}
+    },
+    'D': {
+	'code': '12',
+	'read': {
+	    'format': '+DDD.DDD'
+	},
+	'write': {
+	    'format': '+DDD.DDD',
+	    'range': '+001.000 +100.000',
+            'alias': {
+                'OFF': '+000.000'
+            }
+	}
+    },
+    'A_T': {
+	'code': '21',
+	'read': {
+	    'format': '+DDD.DDD'
+	},
+	'write': {
+	    'format': '+DDD.DDD',
+	    'range': temp_lims
+	}
+    },
+    'A_R': {
+	'code': '22',
+	'read': {
+	    'format': '+DDD.DDD'
+	},
+	'write': {
+	    'format': '+DDD.DDD',
+	    'range': res_lims
+	}
+    },
+    'B_T': {
+	'code': '23',
+	'read': {
+	    'format': '+DDD.DDD'
+	},
+	'write': {
+	    'format': '+DDD.DDD',
+	    'range': temp_lims
+	}
+    },
+    'B_R': {
+	'code': '24',
+	'read': {
+	    'format': '+DDD.DDD'
+	},
+	'write': {
+	    'format': '+DDD.DDD',
+	    'range': res_lims
+	}
+    },
+    'C_T': {
+	'code': '25',
+	'read': {
+	    'format': '+DDD.DDD'
+	},
+	'write': {
+	    'format': '+DDD.DDD',
+	    'range': temp_lims
+	}
+    },
+    'C_R': {
+	'code': '26',
+	'read': {
+	    'format': '+DDD.DDD'
+	},
+	'write': {
+	    'format': '+DDD.DDD',
+	    'range': res_lims
+	}
+    },
+    'T_LIM_HIGH': {
+	'code': '31',
+	'read': {
+	    'format': '+DDD.DDD'
+	},
+	'write': {
+	    'format': '+DDD.DDD',
+	    'range': temp_lims
+	}
+    },
+    'T_LIM_LOW': {
+	'code': '32',
+	'read': {
+	    'format': '+DDD.DDD'
+	},
+	'write': {
+	    'format': '+DDD.DDD',
+	    'range': temp_lims
+	}
+    },
+    'OUTPUT': {
+	'code': '51',
+	'read': {
+	    'format': '+DDD.DDD',
+            'info': """Format is: +0<AE><AS>.<TL><IS><OS>:
+            AE: Autotune Error Codes:
+            	0: No error
+            	1: Zero value current limit error
+            	2: Current limit cannot reach SET T
+            	3: Non-uniform TE I step measured
+            	4: Rate sign change
+            AS: Autotune Status:
+            	0: Normal
+            	1: Autotune
+            TL: Temperature Limit or Error Limit Status:
+            	0: Normal
+            	1: Requires cleaning
+            IS: Integrator Status:
+            	0: OFF
+            	1: ON
+            OS: Output Status:
+            	0: OFF
+            	1: ON"""
+		},
+	'write': {
+	    'format': '+DDD.DDD',
+	    'alias': {
+                'ON': '+000.001',
+                'OFF': '+000.000'
+            }
+	}
+    },
+    'HALT': {
+	'code': '52',
+        'read': {},
+	'write': {
+	    'format': '+DDD.DDD',
+	}
+    },
+    'LOCAL': {
+	'code': '53',
+        'read': {},
+	'write': {
+	    'format': '+DDD.DDD',
+	}
+    }
+}
+
+class LFIError(Exception):
+    pass
+
+class LFITimeout(LFIError):
+    pass
+
+def make_codec(check_fcs = True):
+    """Return a codec.Codec for device_commands and the LFI-3751 protocol."""
+    return Codec(
+        device_commands,
+        unit_type = unit_type,
+        cmd_char = cmd_char,
+        read_char = read_char,
+        write_char = write_char,
+        reply_length = reply_length,
+        first_data_char = first_data_char,
+        last_data_char = last_data_char,
+        check_fcs = check_fcs
+    )
+
+def unit_address(unit):
+    """Return the address of unit (int or str) as a 2 digit str.
+
+    Raises ValueError if it is not a valid address.
+    """
+    try:
+        address = int(unit)
+    except (TypeError, ValueError):
+        address = None
+    if address is None or not min_unit_address <= address <= max_unit_address:
+        raise ValueError('Invalid unit address: {unit!r}'.format(unit = unit))
+    return '{address:0>2d}'.format(address = address)
+
+def ramp_steps(start, stop, rate, interval = 1, command = 'SET_T',
+               delay = 0):
+    """Return the profile steps of a linear ramp of command.
+
+    The value goes from start to stop at rate (e.g. degrees) per second,
+    with a step every interval seconds from delay on and the last one
+    exactly at stop. Values are rounded to the 3 decimals of the device and
+    steps which would not change it are left out.
+    """
+    if not rate > 0 or not interval > 0:
+        raise ValueError('Ramp rate and interval must be positive')
+
+    duration = abs(stop - start) / rate
+    steps = []
+    step_time = 0
+    while step_time < duration:
+        value = round(start + copysign(rate * step_time, stop - start), 3)
+        if not steps or value != steps[-1][2]:
+            steps.append((delay + step_time, command, value))
+        step_time += interval
+    steps.append((delay + duration, command, round(stop, 3)))
+    return steps
+
+class UnitConnection():
+    """A binary framed connection to the daemon of a unit for asyncio.
+
+    A reader task hands every frame received to the queue of its tag, so
+    that any number of requests and subscriptions can share the connection
+    and a reply which comes after its request timed out is dropped rather
+    than taken for the reply to the next one. Queues get None when the
+    connection is closed.
+
+    Packets are (reply_length, data) pairs as in framing.pack_request(),
+    replies are the (status, flags, data, age) entries of the daemon.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tag = 0
+        self.queues = {}
+        self.writer = None
+
+    @property
+    def closed(self):
+        return self.writer is None
+
+    async def open(self):
+        """Connect to the daemon, raises OSError if it cannot be reached."""
+        import asyncio
+
+        reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.reader_task = asyncio.ensure_future(self.__read_frames(reader))
+
+    def close(self):
+        if self.writer is not None:
+            self.reader_task.cancel()
+            self.writer.close()
+            self.writer = None
+
+    async def request(self, packets, timeout):
+        """Send packets in one request and return the replies.
+
+        Raises LFITimeout if the daemon does not reply within timeout
+        seconds and LFIError if it replies with an error or the connection
+        is closed.
+        """
+        import asyncio
+
+        tag, queue = self.__send_frame(MSG_REQUEST, pack_request(packets))
+        try:
+            frame = await asyncio.wait_for(queue.get(), timeout)
+        except asyncio.TimeoutError:
+            raise LFITimeout('No reply from the daemon at {path}'.format(
+                path = self.path))
+        finally:
+            del self.queues[tag]
+
+        return unpack_reply(self.__payload(frame, MSG_REPLY))
+
+    async def samples(self, packets, interval):
+        """Have the daemon send packets every interval seconds.
+
+        Yields the time of each sample and the replies to it, raises
+        LFIError as request() does. The subscription is cancelled when the
+        generator is closed.
+        """
+        tag, queue = self.__send_frame(
+            MSG_SUBSCRIBE, pack_subscribe(interval, packets))
+        try:
+            while True:
+                yield unpack_sample(self.__payload(await queue.get(),
+                                                   MSG_SAMPLE))
+        finally:
+            del self.queues[tag]
+            if self.writer is not None:
+                self.writer.write(pack_frame(MSG_UNSUBSCRIBE, tag = tag))
+
+    async def profile(self, steps):
+        """Have the daemon send (time, reply_length, data) steps.
+
+        Yields the progress records (see framing.py) the daemon pushes,
+        the first one telling the id of the profile, until it is done or
+        aborted. Closing the generator does not stop the profile.
+        """
+        tag, queue = self.__send_frame(MSG_PROFILE, pack_profile(steps))
+        try:
+            while True:
+                for record in unpack_progress(self.__payload(
+                        await queue.get(), MSG_PROGRESS)):
+                    yield record
+                    if record[1] in (PROFILE_DONE, PROFILE_ABORTED):
+                        return
+        finally:
+            del self.queues[tag]
+
+    async def control_profile(self, action, profile_id, timeout):
+        """Apply a PROFILE_* action to a profile (all if profile_id is 0).
+
+        Returns the progress records of the profiles it applied to, raises
+        as request() does.
+        """
+        import asyncio
+
+        tag, queue = self.__send_frame(
+            MSG_PROFILE_CONTROL, pack_profile_control(action, profile_id))
+        try:
+            frame = await asyncio.wait_for(queue.get(), timeout)
+        except asyncio.TimeoutError:
+            raise LFITimeout('No reply from the daemon at {path}'.format(
+                path = self.path))
+        finally:
+            del self.queues[tag]
+
+        return unpack_progress(self.__payload(frame, MSG_PROGRESS))
+
+    def __payload(self, frame, msg_type):
+        if frame is None:
+            raise LFIError('Connection to the daemon at {path} closed'.format(
+                path = self.path))
+        if frame[0] != msg_type:
+            raise LFIError('Daemon replied with an error: {error}'.format(
+                error = frame[1].decode('utf-8', 'replace')))
+        return frame[1]
+
+    def __send_frame(self, msg_type, payload):
+        import asyncio
+
+        if self.writer is None:
+            raise LFIError('Connection to the daemon at {path} closed'.format(
+                path = self.path))
+        self.tag = (self.tag + 1) & 0xFFFF
+        queue = self.queues[self.tag] = asyncio.Queue()
+        self.writer.write(pack_frame(msg_type, payload, tag = self.tag))
+        return self.tag, queue
+
+    async def __read_frames(self, reader):
+        import asyncio
+
+        try:
+            while True:
+                magic, version, msg_type, flags, tag, length = \
+                    FRAME_HEADER.unpack(await reader.readexactly(
+                        FRAME_HEADER.size))
+                if magic != FRAME_MAGIC:
+                    break
+                payload = await reader.readexactly(length)
+                if tag in self.queues:
+                    self.queues[tag].put_nowait((msg_type, payload))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            for queue in self.queues.values():
+                queue.put_nowait(None)
+
+class LFIClient():
+    """An asyncio client for any number of units, see module documentation.
+
+    Accepted options for the constructor:
+
+    socket_dir, socket_name
+        Where the daemons' sockets are, socket_name with <id> standing for
+        the unit address, as in the lfi-3751-control configuration.
+
+    timeout
+        Default timeout in seconds of a request, per command in it.
+
+    codec
+        The codec.Codec to use, by default make_codec().
+
+    A client must only be used from one event loop.
+    """
+
+    def __init__(
+            self,
+            socket_dir = SOCKET_DIR,
+            socket_name = SOCKET_NAME,
+            timeout = SOCKET_TIMEOUT,
+            codec = None
+    ):
+        self.socket_dir = socket_dir
+        self.socket_name = socket_name
+        self.timeout = timeout
+        self.codec = codec if codec is not None else make_codec()
+        self.connections = {}       # unit -> (UnitConnection, open future)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def socket_path(self, unit):
+        return os.path.join(
+            self.socket_dir,
+            self.socket_name.replace('<id>', unit_address(unit)))
+
+    async def connect(self, unit):
+        """Return the open UnitConnection to the daemon of unit.
+
+        The connection is opened on first use and again after it was
+        closed. Raises OSError if the daemon cannot be reached.
+        """
+        import asyncio
+
+        unit = unit_address(unit)
+        try:
+            conn, opened = self.connections[unit]
+        except KeyError:
+            conn = None
+        if conn is None or (opened.done() and conn.closed):
+            conn = UnitConnection(self.socket_path(unit))
+            opened = asyncio.ensure_future(conn.open())
+            self.connections[unit] = conn, opened
+
+        try:
+            # shielded, a cancelled caller must not cancel it for the others
+            await asyncio.shield(opened)
+        except OSError:
+            if self.connections.get(unit, (None,))[0] is conn:
+                del self.connections[unit]
+            raise
+        return conn
+
+    def close(self):
+        """Close all connections."""
+        for conn, opened in self.connections.values():
+            if opened.done():
+                conn.close()
+            else:
+                opened.cancel()
+        self.connections = {}
+
+    async def request(self, unit, commands, timeout = None, raw = False):
+        """Send commands to unit in one request and return their values.
+
+        commands are command names (reads) or (command, value) pairs, an
+        empty value meaning a read. Returns a value for each command, None
+        for those without a reply or without a valid one. timeout is for the
+        whole request, by default the client's timeout for each command.
+
+        Raises codec.CodecError for invalid commands or values, LFITimeout if
+        the daemon does not reply in time, LFIError if it replies with an
+        error and OSError if it cannot be reached.
+        """
+        address = unit_address(unit)
+        commands = [(command, '') if isinstance(command, str) else
+                    (command[0], _to_str(command[1])) for command in commands]
+        packets = [self.__packet(command, value, address)
+                   for command, value in commands]
+        if timeout is None:
+            timeout = self.timeout * len(packets)
+
+        conn = await self.connect(address)
+        replies = await conn.request(packets, timeout)
+        return self.__values(commands, replies, raw)
+
+    async def read(self, unit, command, timeout = None, raw = False):
+        """Return the value of command read from unit.
+
+        Raises LFIError if the unit gives no valid reply, see request().
+        """
+        value, = await self.request(unit, [command], timeout, raw)
+        if value is None:
+            raise LFIError('No valid reply to {command} from unit {unit}'.format(
+                command = command,
+                unit = unit_address(unit)))
+        return value
+
+    async def write(self, unit, command, value, timeout = None, raw = False):
+        """Write value (number or alias) to command of unit.
+
+        Returns the value the unit replied with, None for commands without a
+        reply. Raises LFIError if the unit gives no valid reply, see
+        request().
+        """
+        reply, = await self.request(unit, [(command, value)], timeout, raw)
+        if reply is None and self.codec.expects_reply(command):
+            raise LFIError('No valid reply to {command} from unit {unit}'.format(
+                command = command,
+                unit = unit_address(unit)))
+        return reply
+
+    async def read_all(self, command, units, timeout = None, raw = False):
+        """Read command from all units at once.
+
+        Returns a dictionary of unit (as given) -> value, None for units
+        which could not be read.
+        """
+        import asyncio
+
+        values = await asyncio.gather(
+            *[self.read(unit, command, timeout, raw) for unit in units],
+            return_exceptions = True)
+        return {unit: None if isinstance(value, (LFIError, OSError)) else value
+                for unit, value in zip(units, _raise_other(values))}
+
+    async def samples(self, unit, commands, interval, raw = False):
+        """Have the daemon of unit read commands every interval seconds.
+
+        Yields the time of each sample (seconds since the epoch) and the
+        values read, None for those without a valid reply. Raises as
+        request() does; the daemon stops reading when the generator is
+        closed.
+        """
+        address = unit_address(unit)
+        commands = [(command, '') for command in commands]
+        packets = [self.__packet(command, value, address)
+                   for command, value in commands]
+        conn = await self.connect(address)
+        samples = conn.samples(packets, interval)
+        try:
+            async for timestamp, replies in samples:
+                yield timestamp, self.__values(commands, replies, raw)
+        finally:
+            await samples.aclose()
+
+    async def run_profile(self, unit, steps, raw = False):
+        """Have the daemon of unit send (time, command, value) steps.
+
+        Times are in seconds from the start of the profile, in order, and
+        values as in request(). Yields the progress of the profile, a
+        dictionary with its id, state (one of PROFILE_STATES), the number of
+        steps done, the total number, the seconds elapsed on the profile's
+        clock and the value the unit replied with to the last step, until it
+        is done or aborted. Closing the generator does not stop the profile,
+        see control_profile(). Raises as request() does.
+        """
+        address = unit_address(unit)
+        commands = []
+        packets = []
+        for step_time, command, value in steps:
+            commands.append((command, _to_str(value)))
+            packets.append((step_time,) + self.__packet(
+                command, commands[-1][1], address))
+        conn = await self.connect(address)
+        records = conn.profile(packets)
+        try:
+            async for record in records:
+                progress = self.__progress(record)
+                status, reply, done = record[5], record[6], record[2]
+                progress['value'] = None
+                if done:
+                    progress['value'] = self.__values(
+                        commands[done - 1 : done],
+                        [(status, 0, reply, None)], raw)[0]
+                yield progress
+        finally:
+            await records.aclose()
+
+    async def control_profile(self, unit, action, profile_id = 0,
+                              timeout = None):
+        """Query, hold, resume or abort (action) profiles of unit's daemon.
+
+        Applies to all profiles of the daemon (which may serve other units
+        on the same bus too) if profile_id is 0. Holding a profile stops its
+        clock until it is resumed. Returns the progress of the profiles it
+        applied to, as run_profile() does but without the value. Raises as
+        request() does.
+        """
+        try:
+            action = PROFILE_ACTIONS[action]
+        except KeyError:
+            raise ValueError('Unknown profile action: {action!r}'.format(
+                action = action))
+        if timeout is None:
+            timeout = self.timeout
+
+        conn = await self.connect(unit)
+        return [self.__progress(record) for record in
+                await conn.control_profile(action, profile_id, timeout)]
+
+    def __progress(self, record):
+        profile_id, state, done, total, elapsed, status, reply = record
+        return {
+            'id': profile_id,
+            'state': PROFILE_STATES.get(state, state),
+            'done': done,
+            'total': total,
+            'elapsed': elapsed,
+        }
+
+    def __packet(self, command, value, address):
+        data = self.codec.encode(command, value, address)
+        if not self.codec.expects_reply(command):
+            return 0, data
+        return self.codec.reply_length, data
+
+    def __values(self, commands, replies, raw):
+        values = []
+        for (command, value), (status, flags, reply, age) in zip(commands,
+                                                                replies):
+            data = None
+            if status in (STATUS_OK, STATUS_PARTIAL):
+                data = self.codec.decode(command, value, reply)
+            if data is not None and not raw:
+                data = float(data)
+            values.append(data)
+        # commands which got no reply at all
+        values.extend([None] * (len(commands) - len(values)))
+        return values
+
+class SyncLFIClient():
+    """An LFIClient for code not using asyncio.
+
+    Takes the options of LFIClient and has its methods (samples() and
+    run_profile() being plain generators), which block until the result is
+    there. The client's
+    event loop runs in a thread of its own, so a SyncLFIClient may be used
+    from any number of threads at once.
+    """
+
+    def __init__(self, **kwargs):
+        import asyncio
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target = self.loop.run_forever,
+                                       daemon = True)
+        self.thread.start()
+        self.client = LFIClient(**kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def request(self, unit, commands, timeout = None, raw = False):
+        return self.__run(self.client.request(unit, commands, timeout, raw))
+
+    def read(self, unit, command, timeout = None, raw = False):
+        return self.__run(self.client.read(unit, command, timeout, raw))
+
+    def write(self, unit, command, value, timeout = None, raw = False):
+        return self.__run(self.client.write(unit, command, value, timeout,
+                                            raw))
+
+    def read_all(self, command, units, timeout = None, raw = False):
+        return self.__run(self.client.read_all(command, units, timeout, raw))
+
+    def samples(self, unit, commands, interval, raw = False):
+        return self.__iterate(
+            self.client.samples(unit, commands, interval, raw))
+
+    def run_profile(self, unit, steps, raw = False):
+        return self.__iterate(self.client.run_profile(unit, steps, raw))
+
+    def control_profile(self, unit, action, profile_id = 0, timeout = None):
+        return self.__run(self.client.control_profile(
+            unit, action, profile_id, timeout))
+
+    def close(self):
+        """Close all connections and stop the event loop."""
+        if self.loop.is_closed():
+            return
+
+        async def close():
+            self.client.close()
+        self.__run(close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __iterate(self, generator):
+        # an async generator of the client as a plain one
+        try:
+            while True:
+                try:
+                    yield self.__run(_next(generator))
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.__run(generator.aclose())
+
+    def __run(self, coroutine):
+        import asyncio
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+def _to_str(value):
+    # values may be given as numbers, the codec formats them
+    if isinstance(value, str):
+        return value
+    return repr(float(value))
+
+async def _next(generator):
+    # run_coroutine_threadsafe() takes coroutines only
+    return await generator.__anext__()
+
+def _raise_other(results):
+    # results of gather(return_exceptions = True), with anything but the
+    # errors of a unit raised
+    for result in results:
+        if isinstance(result, BaseException) \
+           and not isinstance(result, (LFIError, OSError)):
+            raise result
+    return results
@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Copyright (C) 2015 Aleksandrina Nikolova <aayla.secura.1138@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+# Text and binary data logs of lfi-3751-control
+# Requires numpy for load_log
+
+"""Writers, a reader and a converter for data logs.
+
+A log has a number of named columns (e.g. time/s, ACT_T, TE_I) and one row
+per data point. It is stored in one of two formats:
+
+text
+    Tab separated values, the first line being '#' followed by the column
+    names; missing values are 'null'.
+
+binary
+    HEADER (magic, version, length of the column names), the column names
+    separated by tabs and padded with zeros to a multiple of 8 bytes, then
+    one record per row of little-endian float64 values; missing values are
+    NaN. A record cut short (e.g. by a crash) at the end is ignored.
+
+Writers buffer rows and write them out at most every flush_interval
+seconds, and with fsync_interval, also fsync the file at most that often.
+The format of an existing log is told from its first bytes, so that it can
+be appended to without knowing it.
+
+Writers given the unit they log may also keep a Manifest of the directory
+they write to up to date: a file with a line (JSON) for every log with
+its unit, columns, time of the last row and size at the last flush. Lines
+are only appended, the last one for a log is the valid one and the logs
+are in the order they were last written to, so that the latest log of a
+unit and its last time can be found without looking at any of the logs.
+The manifest is compacted every now and then and can be rebuilt from the
+logs if it is missing or stale (a log's size differs from the one in it).
+
+The module can be run to convert logs:
+    logfile.py binary ACT_T_unit01.log ACT_T_unit01.bin
+    logfile.py text ACT_T_unit01.bin ACT_T_unit01.log
+
+Exported classes:
+TextLogWriter: appends rows to a text log.
+BinaryLogWriter: appends rows to a binary log.
+Manifest: an index of the logs in a directory.
+LogError: raised on invalid or mismatching logs.
+
+Exported functions:
+open_log: open a log for appending, creating it if necessary.
+load_log: return the columns and data of a log as a NumPy array.
+last_row: return the last row of a log without reading all of it.
+convert: convert a log to the other format.
+"""
+
+import argparse
+import io
+import json
+import os
+import struct
+import sys
+from math import isnan
+from time import monotonic
+
+LOG_FORMATS = ['text', 'binary']
+MAGIC = b'LFILOG'
+VERSION = 1
+HEADER = struct.Struct('<6sHI')
+RECORD_DTYPE = '<f8'
+RECORD_SIZE = struct.calcsize('<d')
+
+# columns written as given rather than as device values
+TIME_COLUMNS = ['time/s', 'SET_T']
+
+TEXT_CHUNK = 1 << 24        # bytes of a text log parsed at a time
+
+MANIFEST_NAME = '.manifest'
+COMPACT_EVERY = 1000        # lines appended by a Manifest between compactions
+
+class LogError(Exception):
+    pass
+
+class _LogWriter():
+    # buffering common to both formats, subclasses implement _format_row()
+    # and _write_header()
+
+    def __init__(self, path, columns, flush_interval = 1,
+                 fsync_interval = None, unit = None):
+        self.path = path
+        self.columns = list(columns)
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.rows = []
+        self.last_time = None
+        self.manifest = None
+        if unit is not None and path != os.devnull:
+            self.manifest = Manifest(os.path.dirname(os.path.abspath(path)))
+            self.unit = unit
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self._write_header()
+        self.last_flush = self.last_fsync = monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, row):
+        """Append a row, a value (float, number as str or None) per column."""
+        if len(row) != len(self.columns):
+            raise LogError('Expected {expected} values, got {got}'.format(
+                expected = len(self.columns),
+                got = len(row)))
+
+        self.rows.append(self._format_row(row))
+        self.last_time = _to_float(row[0])
+        now = monotonic()
+        if now - self.last_flush >= self.flush_interval:
+            self.flush()
+            if self.fsync_interval is not None \
+               and now - self.last_fsync >= self.fsync_interval:
+                os.fsync(self.file.fileno())
+                self.last_fsync = now
+
+    def flush(self):
+        """Write out all buffered rows."""
+        if self.rows:
+            self.file.write(b''.join(self.rows))
+            self.rows = []
+        self.file.flush()
+        self.last_flush = monotonic()
+
+        if self.manifest is not None:
+            self.manifest.update(self.path, self.unit, self.columns,
+                                 self.last_time, self.file.tell())
+
+    def close(self):
+        if self.file.closed:
+            return
+
+        self.flush()
+        if self.fsync_interval is not None:
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+class TextLogWriter(_LogWriter):
+    """Appends rows to a text (tab separated values) log.
+
+    Values given as str are written as is, so that device replies are kept
+    exactly, and floats are written with 3 decimals. When appending to an
+    existing log its columns must match.
+    """
+
+    def __init__(self, path, columns, **kwargs):
+        _check_columns(path, columns)
+        super().__init__(path, columns, **kwargs)
+
+    def _write_header(self):
+        self.file.write('#{columns}\n'.format(
+            columns = '\t'.join(self.columns)).encode('ascii'))
+
+    def _format_row(self, row):
+        return ('\t'.join([_format_value(value) for value in row]) +
+                '\n').encode('ascii')
+
+class BinaryLogWriter(_LogWriter):
+    """Appends rows of float64 values to a binary log.
+
+    When appending to an existing log its columns must match and a record
+    cut short at its end is discarded.
+    """
+
+    def __init__(self, path, columns, **kwargs):
+        self.record = struct.Struct('<{count:d}d'.format(count = len(columns)))
+        offset = _check_columns(path, columns)
+        if offset is not None:
+            size = os.path.getsize(path)
+            os.truncate(path, size - (size - offset) % self.record.size)
+        super().__init__(path, columns, **kwargs)
+
+    def _write_header(self):
+        names = '\t'.join(self.columns).encode('ascii')
+        header = HEADER.pack(MAGIC, VERSION, len(names)) + names
+        self.file.write(header + bytes(-len(header) % 8))
+
+    def _format_row(self, row):
+        return self.record.pack(*[_to_float(value) for value in row])
+
+def is_binary(path):
+    """Whether the log at path is in the binary format."""
+    with open(path, 'rb') as log:
+        return log.read(len(MAGIC)) == MAGIC
+
+def read_header(path):
+    """Return the columns of a log and the offset of its first row."""
+    with open(path, 'rb') as log:
+        start = log.read(HEADER.size)
+        if start[:len(MAGIC)] != MAGIC:
+            # text
+            log.seek(0)
+            headline = log.readline().decode('ascii', 'replace')
+            return headline[1:].split(), log.tell()
+
+        if len(start) < HEADER.size:
+            raise LogError('{path}: truncated header'.format(path = path))
+        magic, version, length = HEADER.unpack(start)
+        if version > VERSION:
+            raise LogError('{path}: unsupported version {version}'.format(
+                path = path,
+                version = version))
+        names = log.read(length).decode('ascii')
+        offset = HEADER.size + length
+        return names.split('\t'), offset + (-offset % 8)
+
+def _check_columns(path, columns):
+    # raise LogError if the log at path exists and has other columns, return
+    # the offset of its first row (None if there is no log to append to)
+    if path == os.devnull or not os.path.exists(path) \
+       or os.path.getsize(path) == 0:
+        return None
+
+    old_columns, offset = read_header(path)
+    if old_columns != list(columns):
+        raise LogError('{path} has columns {columns}'.format(
+            path = path,
+            columns = ', '.join(old_columns)))
+    return offset
+
+def open_log(path, columns, log_format = 'text', flush_interval = 1,
+             fsync_interval = None, unit = None):
+    """Open a log for appending rows, creating it if it does not exist.
+
+    An existing, non-empty log is appended to in its own format, otherwise
+    log_format ('text' or 'binary') is used. Raises LogError if an existing
+    log has other columns. If unit is given, the log is kept in the
+    Manifest of its directory.
+    """
+    if os.path.exists(path) and os.path.getsize(path) > 0 \
+       and path != os.devnull:
+        log_format = 'binary' if is_binary(path) else 'text'
+
+    if log_format == 'binary':
+        writer = BinaryLogWriter
+    elif log_format == 'text':
+        writer = TextLogWriter
+    else:
+        raise LogError('Unknown log format: {name!r}'.format(
+            name = log_format))
+    return writer(path, columns, flush_interval = flush_interval,
+                  fsync_interval = fsync_interval, unit = unit)
+
+def load_log(path):
+    """Return the columns and a 2-D float64 array (row per data point).
+
+    Binary logs are memory-mapped rather than read, text logs are parsed
+    TEXT_CHUNK bytes at a time.
+    """
+    # only imported here, writing logs does not need it
+    import numpy
+
+    columns, offset = read_header(path)
+    if is_binary(path):
+        count = (os.path.getsize(path) - offset) // \
+                (RECORD_SIZE * len(columns))
+        if count == 0:
+            return columns, numpy.empty((0, len(columns)))
+        return columns, numpy.memmap(path, dtype = RECORD_DTYPE, mode = 'r',
+                                     offset = offset,
+                                     shape = (count, len(columns)))
+
+    chunks = [numpy.empty((0, len(columns)))]
+    with open(path, 'rb') as log:
+        log.seek(offset)
+        rest = b''
+        while True:
+            block = log.read(TEXT_CHUNK)
+            if not block:
+                break
+            # parse whole lines only
+            block = rest + block
+            end = block.rfind(b'\n') + 1
+            rest = block[end:]
+            if end:
+                chunks.append(_parse_text(block[:end], len(columns)))
+        if rest:
+            try:
+                chunks.append(_parse_text(rest, len(columns)))
+            except ValueError:
+                # last line cut short by a crash
+                pass
+    return columns, numpy.concatenate(chunks)
+
+def last_row(path):
+    """Return the columns and the last row of a log (None if it has none).
+
+    Only the end of the file is read.
+    """
+    columns, offset = read_header(path)
+    size = os.path.getsize(path)
+    with open(path, 'rb') as log:
+        if is_binary(path):
+            record_size = RECORD_SIZE * len(columns)
+            count = (size - offset) // record_size
+            if count == 0:
+                return columns, None
+            log.seek(offset + (count - 1) * record_size)
+            return columns, list(struct.unpack(
+                '<{count:d}d'.format(count = len(columns)),
+                log.read(record_size)))
+
+        # read blocks backwards until a complete line is found
+        block = 4096
+        tail = b''
+        position = size
+        while position > offset:
+            position = max(offset, position - block)
+            log.seek(position)
+            tail = log.read(size - position)
+            lines = tail.rstrip(b'\n').split(b'\n')
+            if len(lines) > 1 or position == offset:
+                line = lines[-1].decode('ascii', 'replace')
+                if not line or line.startswith('#'):
+                    return columns, None
+                return columns, [_to_float(value)
+                                 for value in line.split('\t')]
+        return columns, None
+
+class Manifest():
+    """An index of the logs in a directory, see module documentation.
+
+    Entries are dictionaries with the keys path (relative to the directory),
+    unit, columns, last_time (None if the log has no rows) and size.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self.appended = 0
+
+    def update(self, log_path, unit, columns, last_time, size):
+        """Record the state of a log after it was written to."""
+        line = json.dumps({
+            'path': os.path.relpath(log_path, self.directory),
+            'unit': unit,
+            'columns': columns,
+            'last_time': last_time,
+            'size': size,
+        }) + '\n'
+        # a single write in append mode, so concurrent writers don't mix
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+        self.appended += 1
+        if self.appended % COMPACT_EVERY == 0:
+            self.write(self.entries())
+
+    def entries(self):
+        """Return the valid entries, least recently written log first.
+
+        Returns None if there is no manifest.
+        """
+        entries = {}
+        try:
+            with open(self.path, 'r') as manifest:
+                for line in manifest:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # cut short by a crash
+                        continue
+                    entries.pop(entry['path'], None)
+                    entries[entry['path']] = entry
+        except FileNotFoundError:
+            return None
+        return list(entries.values())
+
+    def get(self, log_path):
+        """Return the entry for a log, None if it is not in the manifest."""
+        path = os.path.relpath(log_path, self.directory)
+        for entry in reversed(self.entries() or []):
+            if entry['path'] == path:
+                return entry
+        return None
+
+    def latest(self, unit):
+        """Return the entry for the last log written for unit, or None."""
+        for entry in reversed(self.entries() or []):
+            if entry['unit'] == unit:
+                return entry
+        return None
+
+    def is_fresh(self, entry):
+        """Whether the log of entry has not changed since it was recorded."""
+        try:
+            return os.path.getsize(
+                os.path.join(self.directory, entry['path'])) == entry['size']
+        except OSError:
+            return False
+
+    def write(self, entries):
+        """Replace the manifest with entries."""
+        temp_path = '{path}.{pid}'.format(path = self.path, pid = os.getpid())
+        with open(temp_path, 'w') as manifest:
+            for entry in entries:
+                manifest.write(json.dumps(entry) + '\n')
+        os.replace(temp_path, self.path)
+
+    def rebuild(self, paths, unit_of):
+        """Replace the manifest with entries read from the logs at paths.
+
+        unit_of(path) returns the unit of a log or None to leave it out.
+        Returns the number of logs in the manifest.
+        """
+        entries = []
+        for path in sorted(paths, key = os.path.getmtime):
+            unit = unit_of(path)
+            if unit is None:
+                continue
+            try:
+                columns, row = last_row(path)
+            except (OSError, LogError, ValueError):
+                continue
+            entries.append({
+                'path': os.path.relpath(path, self.directory),
+                'unit': unit,
+                'columns': columns,
+                'last_time': None if row is None else row[0],
+                'size': os.path.getsize(path),
+            })
+        self.write(entries)
+        return len(entries)
+
+def convert(source, destination, log_format):
+    """Copy the log at source to destination in log_format."""
+    columns, data = load_log(source)
+    if os.path.exists(destination):
+        raise LogError('{path} exists'.format(path = destination))
+
+    with open_log(destination, columns, log_format) as writer:
+        for row in data:
+            writer.write([
+                _to_value(value, column in TIME_COLUMNS)
+                for column, value in zip(columns, row)])
+
+def _format_value(value):
+    if value is None:
+        return 'null'
+    elif isinstance(value, str):
+        return value
+    elif isnan(value):
+        return 'null'
+    return '{value:.3f}'.format(value = value)
+
+def _parse_text(block, column_count):
+    import numpy
+
+    return numpy.loadtxt(io.BytesIO(block.replace(b'null', b'nan')),
+                         delimiter = '\t', comments = '#',
+                         ndmin = 2).reshape(-1, column_count)
+
+def _to_float(value):
+    if value is None or value == 'null':
+        return float('nan')
+    return float(value)
+
+def _to_value(value, is_time):
+    # a float from a log as it would have been logged
+    value = float(value)
+    if isnan(value):
+        return None
+    elif is_time:
+        return value
+    # device values are in the format +DDD.DDD
+    return '{value:+08.3f}'.format(value = value)
+
+def main():
+    ap = argparse.ArgumentParser(
+        description = 'Convert lfi-3751-control logs between formats.')
+    ap.add_argument('format', choices = LOG_FORMATS,
+                    help = 'format to convert to')
+    ap.add_argument('source', help = 'log to convert')
+    ap.add_argument('destination', help = 'converted log (must not exist)')
+    args = ap.parse_args()
+
+    try:
+        convert(args.source, args.destination, args.format)
+    except (OSError, LogError) as error:
+        print(error, file = sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
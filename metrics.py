@@ -0,0 +1,292 @@
+###############################################################################
+#
+# Copyright (C) 2015 Aleksandrina Nikolova <aayla.secura.1138@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+# In-memory counters of a running SerialDaemon
+
+"""In-memory metrics kept by SerialDaemon.
+
+All updates are a few integer operations, so that they can be done on
+every serial exchange. A snapshot of the metrics is a dictionary of plain
+numbers, strings and lists (sent by the daemon as JSON):
+    uptime          seconds since the daemon started
+    counters        name -> count, see COUNTERS
+    gauges          name -> {'value': current, 'peak': highest}, see GAUGES
+    latency         list of histograms of the serial write -> read time,
+                    one per set of labels (e.g. unit and command), each a
+                    dictionary with 'labels', 'buckets' (upper bounds in
+                    seconds), 'counts' (per bucket, the last one for
+                    anything slower than the last bound), 'count', 'sum'
+                    and 'max'
+    lateness        histogram as in latency of how late (in seconds) the
+                    steps of profiles were sent to the device
+    reply_timeouts  unit -> seconds the daemon currently waits for a reply
+                    from it, if it adapts them (see seriald.py)
+
+Exported classes:
+Histogram: counts of values in fixed buckets.
+Gauge: a value going up and down, with its peak.
+DaemonMetrics: everything SerialDaemon counts.
+
+Exported functions:
+quantile: estimate a quantile from bucket counts.
+prometheus: format snapshots in the Prometheus text exposition format.
+"""
+
+from bisect import bisect_left
+from time import monotonic
+
+# upper bounds in seconds, a serial exchange takes from about a millisecond
+# up to the serial timeout
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+                   1.0, 2.0, 5.0)
+# a profile step is late by up to one serial exchange
+LATENESS_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1,
+                    0.2, 0.5, 1.0)
+
+COUNTERS = {
+    'requests': 'packets sent to the device',
+    'cache_hits': 'packets answered from cache',
+    'timeouts': 'packets to which the device did not reply at all',
+    'partial_replies': 'replies shorter than requested',
+    'discarded_replies': 'short replies not sent since reply_length_strict',
+    'connections': 'client connections accepted',
+    'disconnects': 'client connections closed',
+    'framing_errors': 'connections closed for malformed frames',
+    'retries': 'packets sent again after no or a short reply',
+    'failed_exchanges': 'packets without a full reply after all retries',
+    'profile_steps': 'profile steps sent to the device',
+}
+
+GAUGES = {
+    'clients': 'connected clients',
+    'queued_requests': 'requests waiting for the serial port',
+    'profiles': 'profiles running or held',
+}
+
+def quantile(buckets, counts, q, maximum = None):
+    """Estimate the q (0 to 1) quantile from bucket bounds and counts.
+
+    Values are taken to be spread evenly within a bucket, up to maximum
+    (the largest value) if it is given. Returns None if there are no values.
+    """
+    total = sum(counts)
+    if not total:
+        return None
+
+    if maximum is None:
+        maximum = buckets[-1]
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(counts):
+        if count and seen + count >= rank:
+            lower = buckets[i - 1] if i else 0
+            upper = min(buckets[i], maximum) if i < len(buckets) else maximum
+            if upper <= lower:
+                return upper
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+    return maximum
+
+class Histogram():
+    """Counts of values in fixed buckets, plus their number, sum and max."""
+
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        return quantile(self.buckets, self.counts, q, self.max)
+
+    def decay(self):
+        """Halve the counts, so that older values weigh less."""
+        self.counts = [count // 2 for count in self.counts]
+        self.count = sum(self.counts)
+        self.sum /= 2
+
+    def snapshot(self):
+        return {
+            'buckets': list(self.buckets),
+            'counts': list(self.counts),
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+        }
+
+class Gauge():
+    """A value going up and down, remembering the highest it has been."""
+
+    def __init__(self):
+        self.value = 0
+        self.peak = 0
+
+    def add(self, amount = 1):
+        self.value += amount
+        if self.value > self.peak:
+            self.peak = self.value
+
+    def snapshot(self):
+        return {'value': self.value, 'peak': self.peak}
+
+class DaemonMetrics():
+    """Everything SerialDaemon counts, see module documentation."""
+
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.started = monotonic()
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.gauges = {name: Gauge() for name in GAUGES}
+        self.latency = {}          # sorted (label, value) pairs -> Histogram
+        self.lateness = Histogram(LATENESS_BUCKETS)
+        self.reply_timeouts = {}   # unit -> seconds
+
+    def count(self, name, amount = 1):
+        self.counters[name] += amount
+
+    def gauge(self, name, amount):
+        self.gauges[name].add(amount)
+
+    def observe(self, labels, seconds):
+        """Add a serial exchange of labels (a dictionary) to its histogram."""
+        key = tuple(sorted(labels.items()))
+        try:
+            histogram = self.latency[key]
+        except KeyError:
+            histogram = self.latency[key] = Histogram(self.buckets)
+        histogram.observe(seconds)
+
+    def snapshot(self):
+        latency = []
+        for key, histogram in sorted(self.latency.items()):
+            entry = histogram.snapshot()
+            entry['labels'] = dict(key)
+            latency.append(entry)
+
+        return {
+            'uptime': monotonic() - self.started,
+            'counters': dict(self.counters),
+            'gauges': {name: gauge.snapshot()
+                       for name, gauge in self.gauges.items()},
+            'latency': latency,
+            'lateness': self.lateness.snapshot(),
+            'reply_timeouts': dict(self.reply_timeouts),
+        }
+
+def prometheus(snapshots, prefix = 'seriald'):
+    """Return snapshots in the Prometheus text exposition format.
+
+    snapshots is a list of (labels, snapshot) pairs, where labels (a
+    dictionary) are added to every sample of the snapshot, e.g. to tell
+    the daemons of several units apart.
+    """
+    lines = []
+
+    def metric(name, metric_type, help_text, samples):
+        # samples are (suffix, labels, value) triples
+        name = '{prefix}_{name}'.format(prefix = prefix, name = name)
+        lines.append('# HELP {name} {help}'.format(
+            name = name, help = help_text))
+        lines.append('# TYPE {name} {type}'.format(
+            name = name, type = metric_type))
+        for suffix, labels, value in samples:
+            lines.append('{name}{suffix}{labels} {value}'.format(
+                name = name,
+                suffix = suffix,
+                labels = _labels(labels),
+                value = _number(value)))
+
+    metric('uptime_seconds', 'gauge', 'seconds since the daemon started',
+           [('', labels, snapshot['uptime'])
+            for labels, snapshot in snapshots])
+
+    for name, help_text in COUNTERS.items():
+        metric(name + '_total', 'counter', help_text,
+               [('', labels, snapshot['counters'].get(name, 0))
+                for labels, snapshot in snapshots])
+
+    for name, help_text in GAUGES.items():
+        # daemons older than a gauge do not have it
+        gauges = [(labels, snapshot['gauges'][name])
+                  for labels, snapshot in snapshots
+                  if name in snapshot['gauges']]
+        metric(name, 'gauge', help_text,
+               [('', labels, gauge['value']) for labels, gauge in gauges])
+        metric(name + '_peak', 'gauge', 'most ' + help_text,
+               [('', labels, gauge['peak']) for labels, gauge in gauges])
+
+    samples = []
+    for labels, snapshot in snapshots:
+        for histogram in snapshot['latency']:
+            samples.extend(_histogram(dict(labels, **histogram['labels']),
+                                      histogram))
+    metric('exchange_seconds', 'histogram',
+           'time from writing a packet to the device to reading its reply',
+           samples)
+
+    samples = []
+    for labels, snapshot in snapshots:
+        if 'lateness' in snapshot:
+            samples.extend(_histogram(labels, snapshot['lateness']))
+    metric('profile_step_lateness_seconds', 'histogram',
+           'time from when a profile step was due to sending it', samples)
+
+    metric('reply_timeout_seconds', 'gauge',
+           'time the daemon waits for a reply from a unit',
+           [('', dict(labels, unit = unit), seconds)
+            for labels, snapshot in snapshots
+            for unit, seconds in sorted(
+                snapshot.get('reply_timeouts', {}).items())])
+
+    return '\n'.join(lines) + '\n'
+
+def _histogram(series, histogram):
+    # the samples of a histogram snapshot with labels series
+    samples = []
+    cumulative = 0
+    for bound, count in zip(histogram['buckets'] + ['+Inf'],
+                            histogram['counts']):
+        cumulative += count
+        samples.append(('_bucket', dict(series, le = bound), cumulative))
+    samples.append(('_sum', series, histogram['sum']))
+    samples.append(('_count', series, histogram['count']))
+    return samples
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{name}="{value}"'.format(
+            name = name,
+            value = _number(value).replace('\\', r'\\').replace(
+                '"', r'\"').replace('\n', r'\n'))
+        for name, value in labels.items()) + '}'
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -26,21 +26,70 @@ Exported classes:
 SerialDaemon: the daemon listening on port Y communicating with ttySX.
 """
 
+import json
 import lockfile
+import logging
 import os
 import regex
+import selectors
 import signal
 import socket
 import sys
 from syslog import openlog as opensyslog
 from syslog import closelog as closesyslog
 from syslog import syslog as logsyslog
-from syslog import LOG_INFO, LOG_DAEMON, LOG_ERR
+from syslog import LOG_DEBUG, LOG_INFO, LOG_WARNING, LOG_DAEMON, LOG_ERR
 import traceback
 import tempfile
-from time import sleep
+from collections import deque
+from math import isfinite
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from time import monotonic, sleep, time
 from daemon import DaemonContext
 from serial import Serial
+from transport import TRANSPORTS, device_path, make_transport
+import framing
+from metrics import DaemonMetrics, Histogram
+from framing import (
+    FrameReader, FramingError, pack_frame, pack_progress, pack_reply,
+    pack_sample, unpack_profile, unpack_profile_control, unpack_request,
+    unpack_subscribe, PROFILE_ABORT, PROFILE_ABORTED, PROFILE_DONE,
+    PROFILE_HELD, PROFILE_HOLD, PROFILE_QUERY, PROFILE_RESUME,
+    PROFILE_RUNNING, STATUS_OK, STATUS_NO_REPLY, STATUS_PARTIAL,
+    STATUS_DISCARDED)
+
+# samples are not queued for a subscriber with more than this many bytes
+# of replies it has not read yet
+MAX_BACKLOG = 1 << 20
+
+# the loop wakes up at least this often (in seconds), select() cannot wait
+# much longer than 2 ** 31 ms
+MAX_SELECT_TIMEOUT = 3600
+
+# with adaptive_timeout, a unit is waited for ADAPTIVE_FACTOR times the
+# ADAPTIVE_QUANTILE of the time its full replies took, once there are
+# ADAPTIVE_MIN_COUNT of them; the counts are halved every ADAPTIVE_WINDOW
+# replies, so that the timeout follows changes of the line
+ADAPTIVE_QUANTILE = 0.99
+ADAPTIVE_FACTOR = 3
+ADAPTIVE_MIN_COUNT = 20
+ADAPTIVE_MIN_TIMEOUT = 0.01
+ADAPTIVE_WINDOW = 1000
+
+# seconds to wait before sending a packet again, doubled for every retry
+RETRY_BACKOFF = 0.005
+MAX_RETRY_BACKOFF = 0.05
+
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+}
+
+_logger = logging.getLogger(__name__)
+_logger.propagate = False
 
 class SerialDaemon():
     """A wrapper class for Serial and DaemonContext with inet socket support.
@@ -67,6 +116,88 @@ class SerialDaemon():
         3A2G9130 sends 9130 to device BUT does not read a reply since A2G is
             not a valid hex number. Note that these 3 bytes are still discarded
 
+    Several packets can be sent in one request by prefixing them with
+    'batch' and each of them with 4 hex digits giving its length:
+        batch<0-F0-F0-F0-F><packet><0-F0-F0-F0-F><packet>...
+    where each packet is in the format above. Packets are sent to the device
+    one after the other, without serving other clients in between, and a
+    single reply is sent back containing, for each packet in order, a status
+    character, 4 hex digits giving the length of the data read from device
+    and the data itself:
+        <status><0-F0-F0-F0-F><data>...
+    The status is a single decimal digit, one of framing.STATUS_OK (full
+    reply), STATUS_NO_REPLY (no reply was requested), STATUS_PARTIAL (fewer
+    bytes than requested were read) or STATUS_DISCARDED (as STATUS_PARTIAL,
+    but reply_length_strict is set so the data is not sent). For example:
+        batch0009215!10110    sends !10110, reads 21 (0x15) bytes and
+                              replies with 00015<21 bytes of data>
+    Note that a single (non-batch) packet must therefore not start with
+    'batch' and that the whole request, like any other, must fit in
+    data_length bytes.
+
+    Alternatively clients may use the binary framing defined in framing.py.
+    A connection is taken to be framed if the first byte the client sends is
+    framing.FRAME_MAGIC. Framed requests are not limited by data_length, may
+    be split across or share socket reads, and the data in them is passed to
+    and from the device as is, without decoding it.
+
+    Any number of clients may be connected at the same time. Each packet
+    read from a client is queued as a request and requests are served one
+    at a time, taking one request from each client with pending requests in
+    turn, so that a client sending many requests does not stall the others.
+    Replies are sent back to the client which sent the request, in the order
+    its requests were received.
+
+    Framed clients may also subscribe to a set of packets (see framing.py),
+    which the daemon then sends to the device periodically, pushing the
+    replies together with the time they were read to the client. All
+    clients subscribing to the same packets with the same period share a
+    single schedule, so any number of them can watch the device at the
+    cost of one. Schedules are served between requests and a round which
+    is late is not repeated but skipped. Samples are dropped for clients
+    not reading them fast enough.
+
+    Framed clients may also send a profile: packets to be sent to the
+    device at given times from its start (see framing.py), e.g. the set
+    points of a temperature ramp. The daemon runs it on its own monotonic
+    clock, so that its timing does not depend on the client, which may even
+    disconnect, and a step which is late (by at most one serial exchange,
+    since steps are sent between requests as they become due) does not
+    delay the ones after it. Any client may query, hold, resume or abort
+    profiles by their id. Progress is pushed to the client which sent the
+    profile after every step.
+
+    If a cache_policy is given, replies to some reads are cached and sent
+    to any client asking for the same read again within the time allowed by
+    the policy, without talking to the device. Data sent to the device
+    drops the cached replies the policy says it makes stale. In framed
+    replies cached entries have framing.REPLY_CACHED set together with the
+    age of the data; text replies do not tell them apart.
+
+    The daemon keeps counters of its work in memory (see metrics.py): a
+    histogram of the time each packet takes from being written to the device
+    to its reply being read, per set of labels given by command_labels,
+    counts of timeouts, short replies and connections, and the current and
+    peak number of clients and queued requests. A text request of exactly
+    'stats', or a framing.MSG_STATS frame, is answered with a snapshot of
+    them as a JSON object (followed by a newline for text requests).
+
+    A packet which gets no reply, or a short one, is sent again up to
+    serial_retries times, as long as that fits in the timeout of the serial
+    port, which thus stays the longest an exchange may take, and is shared
+    equally between the attempts. With adaptive_timeout, once enough
+    replies of the unit (the 'unit' label of command_labels) were timed,
+    every attempt but the last instead waits only as long as they usually
+    take, so that a lost reply costs little more than the time of a good
+    one; the last attempt waits for what is left of the timeout, so that a
+    unit which became slower is still heard and its timeout grows. With a
+    reply_terminator, a read ends as soon as the terminator is received,
+    rather than waiting for bytes of a frame which were lost.
+
+    Messages are logged to syslog from a background thread through a queue,
+    so that the serial loop never waits for syslog. Messages about single
+    connections and packets are only logged at log_level 'debug'.
+
     This class does not inherit from either DaemonContext or Serial.
     The only export method is start() used to run the daemon.
 
@@ -99,6 +230,14 @@ class SerialDaemon():
 
         Log file used to log exceptions during daemon run.
 
+    log_level
+        :Default: ``'info'``
+
+        Lowest level of messages sent to syslog, one of LOG_LEVELS. At
+        'debug' every connection, request and packet sent to or read from
+        device is logged, which is slow and meant for tracing problems only.
+        Can be changed by reloading the configuration.
+
     pidfile_path
         :Default: ``'/var/run/<name>.pid'``
 
@@ -115,13 +254,23 @@ class SerialDaemon():
         Changing this after the daemon is started requires a restart. Also see
         documentation for serial.py.
 
+    socket_aliases
+        :Default: ``()``
+
+        Paths at which symbolic links to socket_path are created once the
+        daemon is listening, and removed when it stops, e.g. to make one
+        daemon reachable under the socket names of all devices on a bus.
+        Existing symbolic links are replaced, other files are left alone.
+        Changing this after the daemon is started requires a restart.
+
     data_length
         :Default: ``1024``
 
-        Number of bytes to be read from the socket. This MUST be at least the
-        number of bytes that have been sent, otherwise the remainder is read
-        afterwards and is confused for a new packet. See above for details on
-        the data format.
+        Number of bytes to be read from the socket. For text packets this
+        MUST be at least the number of bytes that have been sent, otherwise
+        the remainder is read afterwards and is confused for a new packet.
+        For framed connections it is only the initial size of the receive
+        buffer. See above for details on the data format.
 
     data_encoding
         :Default: ``'utf-8'``
@@ -149,6 +298,62 @@ class SerialDaemon():
         If this is not None, it must be a Serial object and is used instead of
         creating a new one. All options relating to Serial are then ignored.
 
+    transport
+        :Default: ``'auto'``
+
+        How the serial port is accessed, see transport.py. Either a transport
+        object or one of 'pyserial' (through serial_context, closing and
+        reopening /dev/ttyS* ports after every write since flushing them does
+        not work in daemon mode), 'termios' (a raw file descriptor configured
+        with the settings of serial_context and kept open, output is drained
+        with tcdrain) or 'auto' (termios for /dev/ttyS* ports, pyserial for
+        anything else). Changing this after the daemon is started requires a
+        restart. In the configuration file it may also be given for a single
+        device, as <device> : <transport> (e.g. ttyS0 : termios), and is then
+        ignored by daemons of other devices.
+
+    cache_policy
+        :Default: ``None``
+
+        If this is not None, replies from device are cached as it directs.
+        It must have the following methods (see codec.CachePolicy):
+            cache_key(data)
+                Given data to be sent to device, return None if the reply
+                must not be cached, or a (key, ttl) tuple, where key is a
+                hashable identifying the reply and ttl is the number of
+                seconds the reply may be reused for.
+            invalidated_keys(data, keys)
+                Given data to be sent to device and the keys of all cached
+                replies, return the keys of those which are no longer valid
+                once data is sent.
+
+    command_labels
+        :Default: ``None``
+
+        If this is not None, it must be a function which, given data to be
+        sent to device, returns a dictionary of labels (e.g. unit and
+        command, see codec.Codec.command_labels) the time taken by the
+        exchange is counted under. Otherwise all exchanges are counted
+        together.
+
+    reply_terminator
+        :Default: ``None``
+
+        If this is not None, it must be the bytes replies end with; a read
+        then returns as soon as they are received, even if it is short.
+
+    adaptive_timeout
+        :Default: ``False``
+
+        Whether or not to wait for replies only as long as the unit needs,
+        see above. Can be changed in the configuration file.
+
+    serial_retries
+        :Default: ``0``
+
+        The number of times a packet is sent again if it gets no reply or a
+        short one. Can be changed in the configuration file.
+
     In addition to the above arguments, SerialDaemon accepts all arguments
     valid for DaemonContext and Serial and uses them to create the
     corresponding objects (unless daemon_context or serial_context are given)
@@ -159,13 +364,21 @@ class SerialDaemon():
             name = 'seriald',
             config_file = 0,
             log_file = None,
+            log_level = 'info',
             pidfile_path = 0,
             socket_path = 0,
+            socket_aliases = (),
             reply_length_strict = False,
             data_length = 1024,
             data_encoding = 'utf-8',
             daemon_context = None,
             serial_context = None,
+            transport = 'auto',
+            cache_policy = None,
+            command_labels = None,
+            reply_terminator = None,
+            adaptive_timeout = False,
+            serial_retries = 0,
             **kwargs
     ):
 
@@ -180,6 +393,10 @@ class SerialDaemon():
             self.log_file = os.path.join(
                 tempfile.gettempdir(), '{name}.log'.format(
                     name = self.name))
+        self.log_level = log_level
+        self.__trace = False       # log every packet? set by log_level
+        self.log_queue = SimpleQueue()
+        self.log_listener = None
             
         self.pidfile_path = pidfile_path
         if self.pidfile_path == 0:
@@ -188,10 +405,23 @@ class SerialDaemon():
         self.socket_path = socket_path
         if self.socket_path == 0:
             self.socket_path = '/var/run/{name}.socket'.format(name = self.name)
+        self.socket_aliases = socket_aliases
             
         self.reply_length_strict = reply_length_strict
         self.data_length = data_length
         self.data_encoding = data_encoding
+        self.transport = transport
+        self.cache_policy = cache_policy
+        self.cache = {}            # key -> (time read, reply)
+        self.schedules = {}        # MSG_SUBSCRIBE payload -> _Schedule
+        self.profiles = {}         # id -> _Profile
+        self.profile_id = 0        # id of the last profile
+        self.command_labels = command_labels
+        self.reply_terminator = reply_terminator
+        self.adaptive_timeout = adaptive_timeout
+        self.serial_retries = serial_retries
+        self.reply_times = {}      # unit -> Histogram of full replies
+        self.metrics = DaemonMetrics()
         
         self.daemon_context = daemon_context
         if self.daemon_context is None:
@@ -220,105 +450,559 @@ class SerialDaemon():
 
         with open(self.log_file, 'a') as log_file:
             try:
-                soc = None
-                # flush doesn't work in daemon mode for ttyS?
-                # close and reopen instead
-                device = self.serial_context.port
-                is_ttyS = True
-                try:
-                    # is it a number? Serial defaults to /dev/ttyS? if so
-                    device += 0
-                except TypeError:
-                    # not a number, assume string
-                    try:
-                        if not device.startswith('/dev/ttyS'):
-                            raise AttributeError
-                    except AttributeError:
-                        # not a string or not a ttyS? device
-                        # assume flushing works
-                        is_ttyS = False
-                else:
-                    device = '/dev/ttyS{num}'.format(num = device)
-                                
-                while True:
-                    if not soc or soc.fileno() < 0:
-                        logsyslog(LOG_INFO, 'Waiting for connection')
-                        soc, soc_addr = self.socket.accept()
-                        logsyslog(LOG_INFO, ('Connected to {addr}').format(
-                            addr = soc_addr))
-
-                    data = soc.recv(self.data_length).decode(
-                        self.data_encoding)
-                    if data == '':
-                        logsyslog(LOG_INFO, 'Closing connection')
-                        soc.close()
-                        continue
-                    elif data == 'device':
-                        logsyslog(LOG_INFO, 'Device path requested')
-                        try:
-                            soc.sendall(device.encode(self.data_encoding))
-                        except ConnectionResetError:
-                            soc.close()
-                        continue
+                self.device = device_path(self.transport.port)
 
-                    logsyslog(LOG_INFO, 'Read from socket: {data}'.format(
-                        data = data))
-
-                    reply_length_byte_length = 0
-                    try:
-                        reply_length_byte_length = int(data[0], 16)
-                        reply_length = int(
-                            data[1 : reply_length_byte_length + 1], 16)
-                    except ValueError:
-                        reply_length = 0
-                    data = data[reply_length_byte_length + 1:]
-
-                    if not self.serial_context.isOpen():
-                        # first time in the loop
-                        logsyslog(LOG_INFO, 'Opening serial port')
-                        self.serial_context.open()
-                        
-                    logsyslog(LOG_INFO, 'Sending {data}'.format(
-                        data = data))
-                    # discard any input or output
-                    self.serial_context.flushOutput()
-                    self.serial_context.flushInput()
-                    self.serial_context.write(data.encode(self.data_encoding))
-                    
-                    if is_ttyS:
-                        self.serial_context.close()
-                        self.serial_context.open()
+                self.socket.setblocking(False)
+                self.selector = selectors.DefaultSelector()
+                self.selector.register(self.socket, selectors.EVENT_READ)
+                # clients with pending requests, served in turn
+                self.ready_clients = deque()
+
+                _logger.info('Waiting for connections')
+                while True:
+                    # don't block while there are requests waiting
+                    # or past the time the next schedule or profile step
+                    # is due
+                    due = [schedule.next_time
+                           for schedule in self.schedules.values()]
+                    due.extend([profile.due
+                                for profile in self.profiles.values()
+                                if profile.state == PROFILE_RUNNING])
+                    if self.ready_clients:
+                        timeout = 0
+                    elif due:
+                        timeout = min(max(0, min(due) - monotonic()),
+                                      MAX_SELECT_TIMEOUT)
                     else:
-                        self.serial_context.flush()
-                            
-                    logsyslog(LOG_INFO, ('Will read {length} bytes').format(
-                        length = reply_length))
-                    
-                    if reply_length > 0:
-                        reply = self.serial_context.read(reply_length)
-                        reply_decoded = reply.decode(self.data_encoding)
-                        logsyslog(LOG_INFO, 'Received {data}'.format(
-                            data = reply_decoded))
-                        if len(reply_decoded) == reply_length \
-                           or not self.reply_length_strict:
-                            try:
-                                soc.sendall(reply)
-                            except ConnectionResetError:
-                                soc.close()
-                                continue
+                        timeout = None
+
+                    for key, events in self.selector.select(timeout):
+                        if key.data is None:
+                            self.__accept()
+                            continue
+
+                        if events & selectors.EVENT_READ:
+                            self.__read(key.data)
+                        if events & selectors.EVENT_WRITE:
+                            self.__write(key.data)
+
+                    # profile steps first, their timing matters most
+                    self.__run_profiles()
+                    self.__acquire()
+
+                    # one request per turn so that new connections and
+                    # requests are picked up between serial transactions
+                    if self.ready_clients:
+                        client = self.ready_clients.popleft()
+                        self.metrics.gauge('queued_requests', -1)
+                        self.__serve(client, client.requests.popleft())
+                        if client.requests and not client.closed:
+                            self.ready_clients.append(client)
 
             except:
                 traceback.print_exc(file = log_file)
                 
         self.__stop()
-                
+
+    def __accept(self):
+        try:
+            soc, soc_addr = self.socket.accept()
+        except BlockingIOError:
+            return
+
+        soc.setblocking(False)
+        client = _Client(soc, FrameReader(self.data_length))
+        self.selector.register(soc, selectors.EVENT_READ, client)
+        self.metrics.count('connections')
+        self.metrics.gauge('clients', 1)
+        _logger.debug('Connected to {addr}'.format(addr = soc_addr))
+
+    def __read(self, client):
+        try:
+            nbytes = client.reader.recv_from(client.socket)
+        except BlockingIOError:
+            return
+        except (ConnectionResetError, OSError):
+            nbytes = 0
+
+        if nbytes == 0:
+            self.__close_client(client)
+            return
+
+        if client.framed is None:
+            # first data from this client, decide on the protocol
+            client.framed = client.reader.buffer[0] == framing.FRAME_MAGIC
+
+        if client.framed:
+            try:
+                requests = client.reader.frames()
+            except FramingError as error:
+                _logger.error('Closing connection: {error}'.format(
+                    error = error))
+                self.metrics.count('framing_errors')
+                self.__close_client(client)
+                return
+        else:
+            # each read is one request, see class documentation
+            requests = [(None, 0, 0, client.reader.take())]
+
+        if requests and not client.requests:
+            self.ready_clients.append(client)
+        client.requests.extend(requests)
+        self.metrics.gauge('queued_requests', len(requests))
+
+    def __write(self, client):
+        try:
+            sent = client.socket.send(client.outbuf)
+        except BlockingIOError:
+            return
+        except (ConnectionResetError, BrokenPipeError, OSError):
+            self.__close_client(client)
+            return
+
+        del client.outbuf[:sent]
+        if not client.outbuf:
+            self.selector.modify(client.socket, selectors.EVENT_READ, client)
+
+    def __reply(self, client, data):
+        if client.closed:
+            return
+
+        was_empty = not client.outbuf
+        client.outbuf.extend(data)
+        if was_empty:
+            self.__write(client)
+            if client.outbuf and not client.closed:
+                # wait until the client can accept the rest
+                self.selector.modify(
+                    client.socket,
+                    selectors.EVENT_READ | selectors.EVENT_WRITE,
+                    client)
+
+    def __close_client(self, client):
+        if client.closed:
+            return
+
+        _logger.debug('Closing connection')
+        client.closed = True
+        self.metrics.count('disconnects')
+        self.metrics.gauge('clients', -1)
+        self.metrics.gauge('queued_requests', -len(client.requests))
+        client.requests.clear()
+        self.__unsubscribe(client)
+        for profile in self.profiles.values():
+            # the profile itself keeps running
+            profile.watchers = [(watcher, tag)
+                                for watcher, tag in profile.watchers
+                                if watcher is not client]
+        try:
+            self.ready_clients.remove(client)
+        except ValueError:
+            pass
+        self.selector.unregister(client.socket)
+        client.socket.close()
+
+    def __serve(self, client, request):
+        msg_type, flags, tag, data = request
+        if msg_type is not None:
+            self.__serve_frame(client, msg_type, tag, data)
+            return
+
+        data = data.decode(self.data_encoding)
+        if data == 'device':
+            _logger.debug('Device path requested')
+            self.__reply(client, self.device.encode(self.data_encoding))
+            return
+
+        if data == 'stats':
+            _logger.debug('Statistics requested')
+            self.__reply(client, (self.__stats() + '\n').encode(
+                self.data_encoding))
+            return
+
+        if data.startswith('batch'):
+            _logger.debug('Batch request')
+            reply = bytearray()
+            data = data[5:]
+            while data:
+                try:
+                    entry_length = int(data[:4], 16)
+                except ValueError:
+                    _logger.error('Invalid batch entry length')
+                    break
+                entry = data[4 : entry_length + 4]
+                data = data[entry_length + 4:]
+                if not entry or len(entry) < entry_length:
+                    _logger.error('Empty or truncated batch entry')
+                    break
+
+                status, entry_reply, age = self.__transact(
+                    *self.__parse_packet(entry))
+                reply.extend('{status:d}{length:0>4X}'.format(
+                    status = status,
+                    length = len(entry_reply)).encode(self.data_encoding))
+                reply.extend(entry_reply)
+            self.__reply(client, reply)
+            return
+
+        status, reply, age = self.__transact(*self.__parse_packet(data))
+        if status in (STATUS_OK, STATUS_PARTIAL):
+            self.__reply(client, reply)
+
+    def __serve_frame(self, client, msg_type, tag, data):
+        if msg_type == framing.MSG_DEVICE:
+            _logger.debug('Device path requested')
+            self.__reply(client, pack_frame(
+                framing.MSG_DEVICE,
+                self.device.encode(self.data_encoding),
+                tag = tag))
+
+        elif msg_type == framing.MSG_STATS:
+            _logger.debug('Statistics requested')
+            self.__reply(client, pack_frame(
+                framing.MSG_STATS, self.__stats().encode(self.data_encoding),
+                tag = tag))
+
+        elif msg_type == framing.MSG_REQUEST:
+            try:
+                entries = unpack_request(data)
+            except FramingError as error:
+                self.__reply_error(client, tag, error)
+                return
+
+            self.__reply(client, pack_frame(
+                framing.MSG_REPLY, pack_reply(self.__transact_all(entries)),
+                tag = tag))
+
+        elif msg_type == framing.MSG_SUBSCRIBE:
+            try:
+                period, entries = unpack_subscribe(data)
+            except FramingError as error:
+                self.__reply_error(client, tag, error)
+                return
+            if not (isfinite(period) and period > 0) or not entries:
+                self.__reply_error(client, tag, 'Invalid subscription')
+                return
+
+            _logger.info('Subscription every {period:g} s'.format(
+                period = period))
+            if data not in self.schedules:
+                self.schedules[data] = _Schedule(period, entries)
+            self.schedules[data].subscribers.append((client, tag))
+
+        elif msg_type == framing.MSG_UNSUBSCRIBE:
+            _logger.info('Subscription cancelled')
+            self.__unsubscribe(client, tag)
+
+        elif msg_type == framing.MSG_PROFILE:
+            try:
+                steps = unpack_profile(data)
+            except FramingError as error:
+                self.__reply_error(client, tag, error)
+                return
+            times = [step[0] for step in steps]
+            if not steps \
+               or not all(isfinite(step_time) and step_time >= 0
+                          for step_time in times) \
+               or any(later < earlier
+                      for earlier, later in zip(times, times[1:])):
+                self.__reply_error(client, tag, 'Invalid profile')
+                return
+
+            self.profile_id = self.profile_id % 0xFFFF + 1
+            while self.profile_id in self.profiles:
+                self.profile_id = self.profile_id % 0xFFFF + 1
+            profile = _Profile(self.profile_id, steps)
+            profile.watchers.append((client, tag))
+            self.profiles[profile.id] = profile
+            self.metrics.gauge('profiles', 1)
+            _logger.info(('Profile {id} of {count} steps over ' +
+                          '{duration:g} s').format(
+                              id = profile.id,
+                              count = len(steps),
+                              duration = times[-1]))
+            self.__progress(profile)
+
+        elif msg_type == framing.MSG_PROFILE_CONTROL:
+            try:
+                action, profile_id = unpack_profile_control(data)
+            except FramingError as error:
+                self.__reply_error(client, tag, error)
+                return
+            if action not in (PROFILE_QUERY, PROFILE_HOLD, PROFILE_RESUME,
+                              PROFILE_ABORT):
+                self.__reply_error(client, tag, 'Unknown profile action')
+                return
+            if profile_id and profile_id not in self.profiles:
+                self.__reply_error(client, tag, 'No such profile')
+                return
+
+            profiles = list(self.profiles.values())
+            if profile_id:
+                profiles = [self.profiles[profile_id]]
+            for profile in profiles:
+                self.__control_profile(profile, action)
+            self.__reply(client, pack_frame(
+                framing.MSG_PROGRESS,
+                pack_progress([profile.record() for profile in profiles]),
+                tag = tag))
+
+        else:
+            _logger.error('Unknown message type {type}'.format(
+                type = msg_type))
+            self.__reply(client, pack_frame(
+                framing.MSG_ERROR, b'Unknown message type', tag = tag))
+
+    def __reply_error(self, client, tag, error):
+        _logger.error('Invalid request: {error}'.format(error = error))
+        self.__reply(client, pack_frame(
+            framing.MSG_ERROR, str(error).encode(self.data_encoding),
+            tag = tag))
+
+    def __stats(self):
+        return json.dumps(self.metrics.snapshot(), sort_keys = True)
+
+    def __transact_all(self, entries):
+        # (status, flags, reply, age) for each (reply_length, data) entry
+        replies = []
+        for reply_length, entry in entries:
+            status, reply, age = self.__transact(reply_length, entry)
+            if age is None:
+                replies.append((status, 0, reply, None))
+            else:
+                replies.append((status, framing.REPLY_CACHED, reply, age))
+        return replies
+
+    def __acquire(self):
+        # serve the schedules which are due
+        for schedule in list(self.schedules.values()):
+            if schedule.next_time > monotonic():
+                continue
+
+            timestamp = time()
+            payload = pack_sample(timestamp,
+                                  self.__transact_all(schedule.entries))
+            for client, tag in schedule.subscribers:
+                if len(client.outbuf) > MAX_BACKLOG:
+                    continue
+                self.__reply(client, pack_frame(
+                    framing.MSG_SAMPLE, payload, tag = tag))
+
+            schedule.next_time += schedule.period
+            if schedule.next_time < monotonic():
+                # too late for this round, skip it
+                schedule.next_time = monotonic() + schedule.period
+
+    def __run_profiles(self):
+        # send the steps of running profiles which are due, in order
+        for profile in list(self.profiles.values()):
+            while profile.state == PROFILE_RUNNING \
+                  and profile.due <= monotonic():
+                self.metrics.lateness.observe(monotonic() - profile.due)
+                self.metrics.count('profile_steps')
+                step_time, reply_length, data = profile.steps[profile.done]
+                profile.status, profile.reply, age = self.__transact(
+                    reply_length, data)
+                profile.done += 1
+                if profile.done == len(profile.steps):
+                    _logger.info('Profile {id} done'.format(id = profile.id))
+                    profile.state = PROFILE_DONE
+                    self.__end_profile(profile)
+                self.__progress(profile)
+
+    def __control_profile(self, profile, action):
+        if action == PROFILE_HOLD and profile.state == PROFILE_RUNNING:
+            _logger.info('Profile {id} held'.format(id = profile.id))
+            profile.state = PROFILE_HELD
+            profile.held = monotonic()
+        elif action == PROFILE_RESUME and profile.state == PROFILE_HELD:
+            _logger.info('Profile {id} resumed'.format(id = profile.id))
+            # the remaining steps are due as much later as it was held
+            profile.start += monotonic() - profile.held
+            profile.held = None
+            profile.state = PROFILE_RUNNING
+        elif action == PROFILE_ABORT:
+            _logger.info('Profile {id} aborted'.format(id = profile.id))
+            profile.state = PROFILE_ABORTED
+            self.__end_profile(profile)
+        else:
+            return
+        self.__progress(profile)
+
+    def __end_profile(self, profile):
+        profile.ended = monotonic()
+        del self.profiles[profile.id]
+        self.metrics.gauge('profiles', -1)
+
+    def __progress(self, profile):
+        # push the state of profile to the clients watching it
+        payload = pack_progress([profile.record()])
+        for client, tag in profile.watchers:
+            if len(client.outbuf) > MAX_BACKLOG:
+                continue
+            self.__reply(client, pack_frame(
+                framing.MSG_PROGRESS, payload, tag = tag))
+
+    def __unsubscribe(self, client, tag = None):
+        # cancel the client's subscription with tag, or all if tag is None
+        for key, schedule in list(self.schedules.items()):
+            schedule.subscribers = [
+                (subscriber, subscriber_tag)
+                for subscriber, subscriber_tag in schedule.subscribers
+                if subscriber is not client
+                or (tag is not None and subscriber_tag != tag)]
+            if not schedule.subscribers:
+                del self.schedules[key]
+
+    def __parse_packet(self, data):
+        # split a text packet into the reply length and data to send
+        if self.__trace:
+            _logger.debug('Read from socket: {data}'.format(data = data))
+
+        reply_length_byte_length = 0
+        try:
+            reply_length_byte_length = int(data[0], 16)
+            reply_length = int(
+                data[1 : reply_length_byte_length + 1], 16)
+        except (IndexError, ValueError):
+            reply_length = 0
+        data = data[reply_length_byte_length + 1:]
+        return reply_length, data.encode(self.data_encoding)
+
+    def __transact(self, reply_length, data):
+        # return status, reply and its age if it came from cache, else None
+        if self.cache_policy is None:
+            return self.__exchange(reply_length, data) + (None,)
+
+        entry = None
+        if reply_length > 0:
+            entry = self.cache_policy.cache_key(data)
+        if entry is None:
+            for key in self.cache_policy.invalidated_keys(data, self.cache):
+                del self.cache[key]
+            return self.__exchange(reply_length, data) + (None,)
+
+        key, ttl = entry
+        now = monotonic()
+        if key in self.cache:
+            read_time, reply = self.cache[key]
+            if now - read_time <= ttl and len(reply) == reply_length:
+                if self.__trace:
+                    _logger.debug('Sending cached reply to {data}'.format(
+                        data = data.decode(self.data_encoding, 'replace')))
+                self.metrics.count('cache_hits')
+                return STATUS_OK, reply, now - read_time
+            del self.cache[key]
+
+        status, reply = self.__exchange(reply_length, data)
+        if status == STATUS_OK:
+            self.cache[key] = (now, reply)
+        return status, reply, None
+
+    def __exchange(self, reply_length, data):
+        if not self.transport.is_open:
+            # first time in the loop
+            _logger.info('Opening serial port')
+            self.transport.open()
+
+        if self.__trace:
+            _logger.debug('Sending {data}'.format(
+                data = data.decode(self.data_encoding, 'replace')))
+        self.metrics.count('requests')
+        labels = {}
+        if self.command_labels is not None:
+            labels = self.command_labels(data) or {}
+        unit = labels.get('unit', '')
+        deadline = None
+        if self.transport.timeout is not None:
+            deadline = monotonic() + self.transport.timeout
+        retries = self.serial_retries
+        backoff = RETRY_BACKOFF
+
+        while True:
+            start = monotonic()
+            # discard any input or output
+            self.transport.discard()
+            self.transport.write(data)
+            self.transport.drain()
+
+            if reply_length <= 0:
+                self.metrics.observe(labels, monotonic() - start)
+                return STATUS_NO_REPLY, b''
+
+            if self.__trace:
+                _logger.debug('Will read {length} bytes'.format(
+                    length = reply_length))
+
+            timeout = None
+            if deadline is not None:
+                timeout = self.__reply_timeout(
+                    unit, max(0, deadline - monotonic()), retries)
+            reply = self.transport.read(reply_length, timeout,
+                                        self.reply_terminator)
+            elapsed = monotonic() - start
+            self.metrics.observe(labels, elapsed)
+            if self.__trace:
+                _logger.debug('Received {data}'.format(
+                    data = reply.decode(self.data_encoding, 'replace')))
+            if len(reply) == reply_length:
+                self.__record_reply_time(unit, elapsed)
+                return STATUS_OK, reply
+            elif not reply:
+                self.metrics.count('timeouts')
+            else:
+                self.metrics.count('partial_replies')
+
+            if retries <= 0 or (deadline is not None and
+                                monotonic() + backoff >= deadline):
+                break
+            retries -= 1
+            self.metrics.count('retries')
+            if self.__trace:
+                _logger.debug('Sending again in {backoff} s'.format(
+                    backoff = backoff))
+            sleep(backoff)
+            backoff = min(2 * backoff, MAX_RETRY_BACKOFF)
+
+        if self.serial_retries > 0:
+            self.metrics.count('failed_exchanges')
+        if self.reply_length_strict:
+            self.metrics.count('discarded_replies')
+            return STATUS_DISCARDED, b''
+        return STATUS_PARTIAL, reply
+
+    def __reply_timeout(self, unit, timeout, retries):
+        # seconds to wait for a reply from unit, out of timeout seconds left
+        # for this and retries more attempts
+        if retries <= 0:
+            return timeout
+        times = self.reply_times.get(unit)
+        if not self.adaptive_timeout or times is None \
+           or times.count < ADAPTIVE_MIN_COUNT:
+            # an equal share of what is left for every attempt
+            return timeout / (retries + 1)
+        return min(timeout, max(ADAPTIVE_MIN_TIMEOUT, ADAPTIVE_FACTOR *
+                                times.quantile(ADAPTIVE_QUANTILE)))
+
+    def __record_reply_time(self, unit, elapsed):
+        times = self.reply_times.get(unit)
+        if times is None:
+            times = self.reply_times[unit] = Histogram()
+        times.observe(elapsed)
+        if times.count >= ADAPTIVE_WINDOW:
+            times.decay()
+        if self.adaptive_timeout and self.transport.timeout is not None:
+            self.metrics.reply_timeouts[unit] = self.__reply_timeout(
+                unit, self.transport.timeout, self.serial_retries)
+        else:
+            self.metrics.reply_timeouts.pop(unit, None)
+
     def __load_config(self):
         def reset_invalid_value(opt):
-            logsyslog(LOG_ERR,
-                      ('{conf}: Invalid value for ' +
-                       '{option}').format(
-                           conf = self.config_file,
-                           option = opt))
+            _logger.error(('{conf}: Invalid value for ' +
+                           '{option}').format(
+                               conf = self.config_file,
+                               option = opt))
             return getattr(self, opt)
 
         conf = _openfile(self.config_file, 'r')
@@ -328,9 +1012,13 @@ class SerialDaemon():
                 regex_pat = regex.compile(r"""\s* (?|
                     (?P<option>
                       reply_length_strict |
+                      adaptive[-_]timeout |
+                      serial[-_]retries |
                       data[-_]length |
                       data[-_]encoding |
                       log[-_]file |
+                      log[-_]level |
+                      transport |
                       pidfile[-_]path |
 		      socket[-_]path
 		    ) \s* (?: =\s* )?
@@ -340,6 +1028,7 @@ class SerialDaemon():
 		        (?P<value> [^#\r\n]+ )
 		    ) )
                     """, regex.X|regex.I)
+                other_pat = regex.compile(r'[\w-]+ \s* = \s* \S', regex.X)
                 
                 line_num = 0
                 for line in conf:
@@ -359,8 +1048,38 @@ class SerialDaemon():
                                          'encoding')):
                             # value is a string
                             val = match.group('value')
-                        elif opt == 'reply_length_strict':
+                        elif opt == 'log_level':
+                            # value must be a known level
+                            val = match.group('value').strip().lower()
+                            if val not in LOG_LEVELS:
+                                val = reset_invalid_value(opt)
+                        elif opt == 'transport':
+                            # value must be a known transport, possibly for
+                            # a device only: <device> : <transport>
+                            device, sep, val = match.group(
+                                'value').rpartition(':')
+                            val = val.strip().lower()
+                            if not isinstance(self.transport, str):
+                                # already started, takes effect on restart
+                                continue
+                            if sep and _device_file(device.strip()) != \
+                               device_path(self.serial_context.port):
+                                # another daemon's device
+                                continue
+                            if val not in TRANSPORTS:
+                                val = reset_invalid_value(opt)
+                        elif opt == 'serial_retries':
+                            # value must be numeric and not negative
+                            try:
+                                val = int(match.group('value'))
+                            except ValueError:
+                                val = -1
+                            if val < 0:
+                                val = reset_invalid_value(opt)
+                        elif opt in ['reply_length_strict',
+                                     'adaptive_timeout']:
                             # value must be a boolean
+                            val = match.group('value')
                             if val.lower() not in ['0', '1', 'false', 'true']:
                                 val = reset_invalid_value(opt)
                             elif val.lower() in ['0', 'false']:
@@ -375,49 +1094,93 @@ class SerialDaemon():
                                 
                         setattr(self, opt, val)
                         
+                    elif other_pat.match(line.strip()):
+                        # an option of another program sharing the file
+                        # (e.g. lfi-3751-control), which checks it
+                        if self.__trace:
+                            _logger.debug(('{conf}: Ignoring unknown option ' +
+                                           'at line {line}').format(
+                                               conf = self.config_file,
+                                               line = line_num))
                     else:
-                        logsyslog(LOG_ERR, ('{conf}: Invalid syntax at line ' +
-                                            '{line}').format(
-                                                conf = self.config_file,
-                                                line = line_num))
+                        _logger.error(('{conf}: Invalid syntax at line ' +
+                                       '{line}').format(
+                                           conf = self.config_file,
+                                           line = line_num))
                         
-            logsyslog(LOG_INFO, 'Loaded configuration from {conf}'.format(
+            _logger.info('Loaded configuration from {conf}'.format(
                 conf = self.config_file))
 
+        self.__set_log_level()
+
+    def __set_log_level(self):
+        _logger.setLevel(LOG_LEVELS.get(self.log_level, logging.INFO))
+        self.__trace = _logger.isEnabledFor(logging.DEBUG)
+
+    def __start_logging(self):
+        # syslog is written to from a thread, which does not survive
+        # daemonizing, so this is called again once the daemon is running
+        self.log_listener = QueueListener(self.log_queue, _SyslogHandler())
+        self.log_listener.start()
+
+    def __stop_logging(self):
+        # send everything which is queued and stop the thread
+        if self.log_listener is not None:
+            self.log_listener.stop()
+            self.log_listener = None
+
     def start(self):
         """
         Load config, daemonize, connect to serial port, listen on socket
         """
         opensyslog(ident = self.name, facility = LOG_DAEMON)
+        _logger.handlers = [QueueHandler(self.log_queue)]
+        self.__set_log_level()
+        self.__start_logging()
         
         self.__load_config()
         if self.pidfile_path is not None:
             self.daemon_context.pidfile = lockfile.FileLock(self.pidfile_path)
             
         if _pidfile_isbusy(self.daemon_context.pidfile):
-            logsyslog(LOG_ERR, 'Already running (pidfile is locked)')
+            _logger.error('Already running (pidfile is locked)')
+            self.__stop_logging()
             closesyslog()
             return
         
         if _socket_isbusy(self.socket_path):
-            logsyslog(LOG_ERR, 'Already running (socket is in use)')
+            _logger.error('Already running (socket is in use)')
+            self.__stop_logging()
             closesyslog()
             return
+
+        if isinstance(self.transport, str):
+            try:
+                self.transport = make_transport(self.transport,
+                                                self.serial_context)
+            except ValueError as error:
+                _logger.error(str(error))
+                self.__stop_logging()
+                closesyslog()
+                return
         
+        self.__stop_logging()
         self.daemon_context.open()
+        self.__start_logging()
         with _openfile(self.daemon_context.pidfile.path, 'w',
                       fail = self.__stop) as file:
             file.write('{pid}'.format(pid = os.getpid()))
         # opening the serial port here doesn't work
         # open it in __run instead
         # self.serial_context.open()
-        logsyslog(LOG_INFO, 'Started')
+        _logger.info('Started')
 
         self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.socket.bind(self.socket_path)
-        self.socket.listen(1)
-        logsyslog(LOG_INFO, ('Listening on socket {socket}').format(
+        self.socket.listen(socket.SOMAXCONN)
+        _logger.info('Listening on socket {socket}'.format(
             socket = self.socket_path))
+        self.__link_aliases()
         self.__run()
         
     def __stop(self):
@@ -425,47 +1188,138 @@ class SerialDaemon():
         if pid is None:
             return
 
-        logsyslog(LOG_INFO, 'Stopping')
+        _logger.info('Stopping')
         
+        self.__unlink_aliases()
         os.remove(self.socket.getsockname())
         os.remove(self.daemon_context.pidfile.path)
         
         self.socket.close()
         
-        if self.serial_context.isOpen():
-            self.serial_context.close()
+        if not isinstance(self.transport, str):
+            self.transport.close()
         self.daemon_context.close()
+        self.__stop_logging()
         
         try:
             os.kill(pid, signal.SIGKILL)
         except OSError:
+            # the log queue is no longer served
             logsyslog(LOG_ERR, 'Could not stop process id {pid}'.format(
                 pid = pid))
         closesyslog()
         
+    def __link_aliases(self):
+        for alias in self.socket_aliases:
+            if os.path.islink(alias):
+                os.remove(alias)
+            elif os.path.lexists(alias):
+                _logger.error('Cannot create alias {alias}: {error}'.format(
+                    alias = alias,
+                    error = 'file exists'))
+                continue
+
+            os.symlink(os.path.relpath(self.socket_path,
+                                       os.path.dirname(alias)), alias)
+            _logger.info('Listening on socket alias {alias}'.format(
+                alias = alias))
+
+    def __unlink_aliases(self):
+        socket_path = os.path.realpath(self.socket.getsockname())
+        for alias in self.socket_aliases:
+            # leave links which have since been pointed elsewhere
+            if os.path.islink(alias) \
+               and os.path.realpath(alias) == socket_path:
+                os.remove(alias)
+
     def __accept_signal(self, sig, frame):
         if sig == signal.SIGHUP:
             self.__load_config()
         else:
-            logsyslog(LOG_INFO, 'Caught signal {sig}'.format(sig = sig))
+            _logger.info('Caught signal {sig}'.format(sig = sig))
             self.__stop()
             
         
+class _SyslogHandler(logging.Handler):
+    """Sends records to syslog, run by the daemon's QueueListener."""
+
+    priorities = {
+        logging.DEBUG: LOG_DEBUG,
+        logging.INFO: LOG_INFO,
+        logging.WARNING: LOG_WARNING,
+        logging.ERROR: LOG_ERR,
+    }
+
+    def emit(self, record):
+        try:
+            logsyslog(self.priorities.get(record.levelno, LOG_ERR),
+                      self.format(record))
+        except Exception:
+            self.handleError(record)
+
+class _Client():
+    """State of a single connection to the daemon socket."""
+
+    def __init__(self, soc, reader):
+        self.socket = soc
+        self.reader = reader       # FrameReader holding data read from soc
+        self.framed = None         # binary framing? unknown until first read
+        self.requests = deque()    # requests waiting for the serial port
+        self.outbuf = bytearray()  # replies not yet sent
+        self.closed = False
+
+class _Schedule():
+    """Packets sent to the device periodically for subscribed clients."""
+
+    def __init__(self, period, entries):
+        self.period = period
+        self.entries = entries     # (reply_length, data) pairs
+        self.subscribers = []      # (client, tag) pairs
+        self.next_time = monotonic()
+
+class _Profile():
+    """Packets sent to the device at given times, see MSG_PROFILE."""
+
+    def __init__(self, profile_id, steps):
+        self.id = profile_id
+        self.steps = steps         # (time, reply_length, data) triples
+        self.done = 0              # number of steps sent
+        self.state = PROFILE_RUNNING
+        self.start = monotonic()   # moved on by the time it was held
+        self.held = None           # when it was held
+        self.ended = None          # when it was done or aborted
+        self.watchers = []         # (client, tag) pairs to push progress to
+        self.status = STATUS_NO_REPLY
+        self.reply = b''           # read from device for the last step
+
+    @property
+    def due(self):
+        return self.start + self.steps[self.done][0]
+
+    def record(self):
+        # the progress record, see framing.py
+        now = monotonic()
+        if self.held is not None:
+            now = self.held
+        elif self.ended is not None:
+            now = self.ended
+        return (self.id, self.state, self.done, len(self.steps),
+                now - self.start, self.status, self.reply)
+
 def _openfile(path, mode = 'r', fail = None):
     path = os.path.realpath(path)
     try:
         file = open(path, mode)
     except IOError as error:
         if repr(error).find('Permission') >= 0:
-            logsyslog(LOG_ERR,
-                      'Cannot {action} {path}. Permission denied.'.format(
-                          action = ('write to' if 'w' in mode else 'read'),
-                          path = path))
+            _logger.error('Cannot {action} {path}. Permission denied.'.format(
+                action = ('write to' if 'w' in mode else 'read'),
+                path = path))
         elif repr(error).find('No such file') >= 0:
-            logsyslog(LOG_ERR, 'No such file or directory: {path}'.format(
+            _logger.error('No such file or directory: {path}'.format(
                 path = path))
         else:
-            logsyslog(LOG_ERR, 'Cannot {action} {path}. Unknown error.'.format(
+            _logger.error('Cannot {action} {path}. Unknown error.'.format(
                 action = ('write to' if 'w' in mode else 'read'),
                 path = path))
     else:
@@ -500,6 +1354,15 @@ def _pidfile_isbusy(pidlock):
     else:
         return True
 
+def _device_file(device):
+    # path to the device file for a device given as in the configuration
+    # file, e.g. 0, ttyS0 or /dev/ttyS0
+    if device.isdigit():
+        return '/dev/ttyS{num}'.format(num = device)
+    elif not device.startswith('/'):
+        return '/dev/{tty}'.format(tty = device)
+    return device
+
 def _socket_isbusy(socket_path):
     if os.path.exists(socket_path):
         return True
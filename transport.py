@@ -0,0 +1,313 @@
+###############################################################################
+#
+# Copyright (C) 2015 Aleksandrina Nikolova <aayla.secura.1138@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+# Serial port backends for seriald
+
+"""Serial port transports used by SerialDaemon.
+
+A transport has the following interface:
+    port          path to the device file
+    is_open       whether the port is open
+    open()        open the port (no-op if already open)
+    close()       close the port (no-op if already closed)
+    discard()     discard any unread input and unsent output
+    write(data)   write all of data (bytes)
+    drain()       wait until all written data has been transmitted
+    read(size, timeout = None, terminator = None)
+                  read up to size bytes, waiting at most timeout seconds
+                  (the transport's own timeout if None) and returning as
+                  soon as terminator (bytes, if not None) has been read
+
+Exported classes:
+PySerialTransport: a transport backed by a serial.Serial object.
+TermiosTransport: a transport using a raw file descriptor and termios.
+
+Exported functions:
+make_transport: create a transport by name for a serial.Serial object.
+device_path: return the path to the device file of a serial.Serial port.
+"""
+
+import os
+import select
+import termios
+from time import monotonic
+
+# accepted names of transports
+TRANSPORTS = ['auto', 'pyserial', 'termios']
+
+class PySerialTransport():
+    """A transport backed by a serial.Serial object.
+
+    If reopen is True, the port is closed and reopened after every write
+    instead of being drained. This is the historical workaround for ttyS
+    ports on which flushing does not work in daemon mode.
+    """
+
+    def __init__(self, serial_context, reopen = False):
+        self.serial_context = serial_context
+        self.reopen = reopen
+        self.timeout = serial_context.timeout
+
+    @property
+    def port(self):
+        return self.serial_context.port
+
+    @property
+    def is_open(self):
+        return self.serial_context.isOpen()
+
+    def open(self):
+        if not self.is_open:
+            self.serial_context.open()
+
+    def close(self):
+        if self.is_open:
+            self.serial_context.close()
+
+    def discard(self):
+        self.serial_context.flushOutput()
+        self.serial_context.flushInput()
+
+    def write(self, data):
+        self.serial_context.write(data)
+
+    def drain(self):
+        if self.reopen:
+            self.serial_context.close()
+            self.serial_context.open()
+        else:
+            self.serial_context.flush()
+
+    def read(self, size, timeout = None, terminator = None):
+        if timeout is None:
+            timeout = self.timeout
+        if timeout != self.serial_context.timeout:
+            self.serial_context.timeout = timeout
+
+        # read_until is only there since pyserial 3.0
+        if terminator is None \
+           or not hasattr(self.serial_context, 'read_until'):
+            return self.serial_context.read(size)
+        return self.serial_context.read_until(terminator, size)
+
+class TermiosTransport():
+    """A transport using a raw, non-blocking file descriptor.
+
+    The port is configured in raw mode with termios and kept open; output is
+    drained with termios.tcdrain and buffers are discarded with
+    termios.tcflush, so no close/reopen cycle is needed between commands.
+    Arguments have the same meaning and accepted values as for serial.Serial.
+    """
+
+    def __init__(
+            self,
+            port,
+            baudrate = 9600,
+            bytesize = 8,
+            parity = 'N',
+            stopbits = 1,
+            xonxoff = False,
+            rtscts = False,
+            timeout = None
+    ):
+        self.port = port
+        self.baudrate = baudrate
+        self.bytesize = bytesize
+        self.parity = parity
+        self.stopbits = stopbits
+        self.xonxoff = xonxoff
+        self.rtscts = rtscts
+        self.timeout = timeout
+        self.fd = None
+
+    @classmethod
+    def from_serial(cls, serial_context):
+        """Create a transport with the same settings as a serial.Serial."""
+        return cls(
+            port = serial_context.port,
+            baudrate = serial_context.baudrate,
+            bytesize = serial_context.bytesize,
+            parity = serial_context.parity,
+            stopbits = serial_context.stopbits,
+            xonxoff = serial_context.xonxoff,
+            rtscts = serial_context.rtscts,
+            timeout = serial_context.timeout
+        )
+
+    @property
+    def is_open(self):
+        return self.fd is not None
+
+    def open(self):
+        if self.is_open:
+            return
+
+        self.fd = os.open(self.port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            self.__configure()
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        if not self.is_open:
+            return
+
+        os.close(self.fd)
+        self.fd = None
+
+    def discard(self):
+        termios.tcflush(self.fd, termios.TCIOFLUSH)
+
+    def write(self, data):
+        with memoryview(data) as view:
+            while view:
+                try:
+                    written = os.write(self.fd, view)
+                except BlockingIOError:
+                    select.select([], [self.fd], [])
+                    continue
+                view = view[written:]
+
+    def drain(self):
+        termios.tcdrain(self.fd)
+
+    def read(self, size, timeout = None, terminator = None):
+        data = bytearray()
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            remaining = None
+        else:
+            remaining = timeout
+            deadline = monotonic() + remaining
+
+        while len(data) < size:
+            if not select.select([self.fd], [], [], remaining)[0]:
+                break
+
+            try:
+                data.extend(os.read(self.fd, size - len(data)))
+            except BlockingIOError:
+                pass
+
+            if terminator is not None and terminator in data:
+                # the end of a frame, even if bytes of it were lost
+                break
+
+            if remaining is not None:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+
+        return bytes(data)
+
+    def __configure(self):
+        iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(
+            self.fd)
+
+        # raw mode, as cfmakeraw(3)
+        iflag &= ~(termios.IGNBRK | termios.BRKINT | termios.PARMRK |
+                   termios.ISTRIP | termios.INLCR | termios.IGNCR |
+                   termios.ICRNL | termios.IXON | termios.IXOFF |
+                   termios.IXANY | termios.INPCK)
+        oflag &= ~termios.OPOST
+        lflag &= ~(termios.ECHO | termios.ECHONL | termios.ICANON |
+                   termios.ISIG | termios.IEXTEN)
+        cflag &= ~(termios.CSIZE | termios.PARENB | termios.PARODD |
+                   termios.CSTOPB | getattr(termios, 'CRTSCTS', 0))
+        cflag |= termios.CLOCAL | termios.CREAD
+
+        try:
+            cflag |= {
+                5: termios.CS5,
+                6: termios.CS6,
+                7: termios.CS7,
+                8: termios.CS8
+            }[self.bytesize]
+        except KeyError:
+            raise ValueError('Invalid byte size: {size!r}'.format(
+                size = self.bytesize))
+
+        if self.parity == 'E':
+            cflag |= termios.PARENB
+        elif self.parity == 'O':
+            cflag |= termios.PARENB | termios.PARODD
+        elif self.parity != 'N':
+            raise ValueError('Unsupported parity: {parity!r}'.format(
+                parity = self.parity))
+        if self.parity != 'N':
+            iflag |= termios.INPCK
+
+        if self.stopbits == 2:
+            cflag |= termios.CSTOPB
+        elif self.stopbits != 1:
+            raise ValueError('Unsupported stop bits: {bits!r}'.format(
+                bits = self.stopbits))
+
+        if self.xonxoff:
+            iflag |= termios.IXON | termios.IXOFF
+        if self.rtscts:
+            cflag |= termios.CRTSCTS
+
+        try:
+            speed = getattr(termios, 'B{rate:d}'.format(rate = self.baudrate))
+        except AttributeError:
+            raise ValueError('Unsupported baud rate: {rate!r}'.format(
+                rate = self.baudrate))
+
+        # reads are timed with select, never block in read()
+        cc[termios.VMIN] = 0
+        cc[termios.VTIME] = 0
+
+        termios.tcsetattr(self.fd, termios.TCSANOW,
+                          [iflag, oflag, cflag, lflag, speed, speed, cc])
+        termios.tcflush(self.fd, termios.TCIOFLUSH)
+
+def make_transport(name, serial_context):
+    """Create a transport called name using the settings of serial_context.
+
+    name is one of TRANSPORTS: 'pyserial', 'termios' or 'auto', which picks
+    termios for /dev/ttyS* ports and pyserial for anything else.
+    """
+    port = device_path(serial_context.port)
+    is_ttyS = isinstance(port, str) and port.startswith('/dev/ttyS')
+
+    if name == 'auto':
+        if is_ttyS:
+            name = 'termios'
+        else:
+            name = 'pyserial'
+
+    if name == 'termios':
+        transport = TermiosTransport.from_serial(serial_context)
+        transport.port = port
+        return transport
+    elif name == 'pyserial':
+        return PySerialTransport(serial_context, reopen = is_ttyS)
+
+    raise ValueError('Unknown transport: {name!r}'.format(name = name))
+
+def device_path(port):
+    """Return the path to the device file for a serial.Serial port."""
+    try:
+        # is it a number? Serial defaults to /dev/ttyS? if so
+        return '/dev/ttyS{num:d}'.format(num = port)
+    except (ValueError, TypeError):
+        return port